@@ -7,7 +7,6 @@ import yaml
 import shutil
 import inspect
 import argparse
-import numpy as np
 import tensorflow as tf
 from resnet import ResNet50
 from utils import *
@@ -41,6 +40,8 @@ def get_parser():
     parser.add_argument('--train_ser_days', type=int, default=0)
     parser.add_argument('--train_con_days', type=int, default=0)
     parser.add_argument('--train_off_days', type=int, default=0)
+    parser.add_argument('--shared_data', type=str2bool, nargs='?', default=False)
+    parser.add_argument('--storage', type=str, default='float32', choices=STORAGE_DTYPES)
     return parser
 
 
@@ -85,25 +86,9 @@ def train_step(src_images, src_labels):
     cross_entropy_loss(batch_cross_entropy_loss)
 
 def set_converter(x, y):
-    dataset = tf.data.Dataset.from_tensor_slices((x, y))
-    dataset = dataset.shuffle(x.shape[0])
-    dataset = dataset.batch(batch_size, drop_remainder=True)
-    return dataset.prefetch(batch_size)
-
-def write_acc(test_set, y_test):
-    test_acc = tf.keras.metrics.CategoricalAccuracy()
-    pred_labels = []
-    for data in test_set:
-        pred_labels.extend(test_step(data[0]))
-    acc = test_acc(pred_labels, y_test).numpy().item()
-    print('acc=', acc)
-
-    path_acc='./tools/acc_generator/logs'
-    if not os.path.exists(path_acc):
-        os.makedirs(path_acc)
-    with open(os.path.join(path_acc, "ADDA"), 'a') as f:
-        f.write("train_src_days="+str(train_src_days)+" train_trg_days="+str(train_trg_days)+" train_ser_days="+str(train_ser_days)+" train_con_days="+str(train_con_days)+" train_off_days="+str(train_off_days)+"\n") 
-        f.write("  acc="+str(acc)+"\n") 
+    # ADDA.core trains and evaluates on one-hot labels
+    data_set = array_dataset(x, y, batch_size, shuffle=True, drop_remainder=True)
+    return data_set.map(lambda x, y: (x, tf.one_hot(y, num_classes)))
 
 if __name__ == '__main__':
     parser = get_parser()
@@ -141,80 +126,31 @@ if __name__ == '__main__':
     '''
     Data Preprocessing
     '''
-    X_data, y_data, classes = get_h5dataset(
-        os.path.join(dataset_path, 'source_data.h5'))
-    X_data, y_data = balance_dataset(X_data,
-                                     y_data,
-                                     num_days=10,
-                                     num_classes=len(classes),
-                                     max_samples_per_class=95)
-
-    # split days of data to train and test
-    X_src = X_data[y_data[:, 1] < train_src_days]
-    y_src = y_data[y_data[:, 1] < train_src_days, 0]
-    y_src = np.eye(len(classes))[y_src]
-    X_train_src, X_test_src, y_train_src, y_test_src = train_test_split(
-        X_src, y_src, stratify=y_src, test_size=0.10, random_state=42)
-
-    X_trg = X_data[y_data[:, 1] >= train_src_days]
-    y_trg = y_data[y_data[:, 1] >= train_src_days]
-    X_train_trg = X_trg[y_trg[:, 1] < train_src_days + train_trg_days]
-    y_train_trg = y_trg[y_trg[:, 1] < train_src_days + train_trg_days, 0]
-    y_train_trg = np.eye(len(classes))[y_train_trg]
-
-    X_test_trg = X_data[y_data[:, 1] >= train_src_days + train_trg_days]
-    y_test_trg = y_data[y_data[:, 1] >= train_src_days + train_trg_days, 0]
-    y_test_trg = np.eye(len(classes))[y_test_trg]
-
-    del X_src, y_src, X_trg, y_trg, X_data, y_data
-
-    # mean center and normalize dataset
-    X_train_src, src_mean = mean_center(X_train_src)
-    X_train_src, src_min, src_ptp = normalize(X_train_src)
-
-    X_test_src, _ = mean_center(X_test_src, src_mean)
-    X_test_src, _, _ = normalize(X_test_src, src_min, src_ptp)
-
-    if (X_train_trg.shape[0] != 0):
-        X_train_trg, trg_mean = mean_center(X_train_trg)
-        X_train_trg, trg_min, trg_ptp = normalize(X_train_trg)
-
-        X_test_trg, _ = mean_center(X_test_trg, trg_mean)
-        X_test_trg, _, _ = normalize(X_test_trg, trg_min, trg_ptp)
-    else:
-        X_test_trg, _ = mean_center(X_test_trg, src_mean)
-        X_test_trg, _, _ = normalize(X_test_trg, src_min, src_ptp)
-
-    X_train_src = X_train_src.astype(np.float32)
-    y_train_src = y_train_src.astype(np.uint8)
-    X_test_src = X_test_src.astype(np.float32)
-    y_test_src = y_test_src.astype(np.uint8)
-    X_train_trg = X_train_trg.astype(np.float32)
-    y_train_trg = y_train_trg.astype(np.uint8)
-    X_test_trg = X_test_trg.astype(np.float32)
-    y_test_trg = y_test_trg.astype(np.uint8)
-
-    X_train_conf, y_train_conf, X_test_conf, y_test_conf = get_trg_data(
-        os.path.join(dataset_path, 'target_conf_data.h5'), classes,
-        train_con_days)
-    X_train_server, y_train_server, X_test_server, y_test_server = get_trg_data(
-        os.path.join(dataset_path, 'target_server_data.h5'), classes,
-        train_ser_days)
-    X_train_office, y_train_office, X_test_office, y_test_office = get_trg_data(os.path.join(
-        dataset_path, 'target_office_data.h5'), classes,
-        train_off_days)
+    X_train_src, y_train_src, X_test_src, y_test_src, \
+        X_train_trg, y_train_trg, X_test_trg, y_test_trg, classes = get_src_data(
+            os.path.join(dataset_path, 'source_data.h5'), train_src_days,
+            train_trg_days, shared=arg.shared_data, storage=arg.storage)
+
+    domains = TargetDomains(classes, shared=arg.shared_data,
+                            storage=arg.storage)
+    domains.register('conference',
+                     os.path.join(dataset_path, 'target_conf_data.h5'),
+                     train_con_days)
+    domains.register('server',
+                     os.path.join(dataset_path, 'target_server_data.h5'),
+                     train_ser_days)
+    domains.register('office',
+                     os.path.join(dataset_path, 'target_office_data.h5'),
+                     train_off_days)
+    # only the adapted target domain is loaded up front, the rest stay on disk
+    domains.prefetch(*domains.trained())
 
     print("Final shapes: ")
     print(" Train Src:   ", X_train_src.shape, y_train_src.shape, "\n",
           "Test Src:    ", X_test_src.shape, y_test_src.shape, "\n",
           "Train Trg:   ", X_train_trg.shape, y_train_trg.shape, "\n",
           "Test Trg:    ", X_test_trg.shape, y_test_trg.shape)
-    print(" Train Conf:  ", X_train_conf.shape, y_train_conf.shape, "\n",
-          "Test Conf:   ", X_test_conf.shape, y_test_conf.shape, "\n",
-          "Train Server:", X_train_server.shape, y_train_server.shape, "\n",
-          "Test Server: ", X_test_server.shape, y_test_server.shape, "\n",
-          "Train Office:", X_train_office.shape, y_train_office.shape, "\n",
-          "Test office: ", X_test_office.shape, y_test_office.shape)
+    domains.summary()
 
 
     src_train_set = set_converter(X_train_src, y_train_src)
@@ -226,16 +162,16 @@ if __name__ == '__main__':
         test_target_set = set_converter( X_test_trg, y_test_trg)
         name_trg_acc = "time test acc" + str(train_trg_days)
     elif train_ser_days > 0:
-        train_target_set = set_converter( X_train_server, y_train_server)
-        test_target_set = set_converter( X_test_server, y_test_server)
+        train_target_set = set_converter(*domains.train('server'))
+        test_target_set = set_converter(*domains.test('server'))
         name_trg_acc = "server test acc" + str(train_ser_days)
     elif train_con_days > 0:
-        train_target_set = set_converter( X_train_conf, y_train_conf)
-        test_target_set = set_converter( X_test_conf, y_test_conf)
+        train_target_set = set_converter(*domains.train('conference'))
+        test_target_set = set_converter(*domains.test('conference'))
         name_trg_acc = "conference test acc" + str(train_con_days)
     elif train_off_days > 0:
-        train_target_set = set_converter( X_train_office, y_train_office)
-        test_target_set = set_converter( X_test_office, y_test_office)
+        train_target_set = set_converter(*domains.train('office'))
+        test_target_set = set_converter(*domains.test('office'))
         name_trg_acc = "office test acc" + str(train_off_days)
 
     '''
@@ -308,6 +244,9 @@ if __name__ == '__main__':
 
     # create save
     run_params = dict(vars(arg))
+    del run_params['shared_data']
+    if arg.storage == 'float32':
+        del run_params['storage']
     sorted(run_params)
     run_params = str(run_params).replace(" ",
                                          "").replace("'",
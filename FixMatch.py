@@ -4,11 +4,10 @@ import yaml
 import shutil
 import inspect
 import argparse
-import numpy as np
 import tensorflow as tf
 import tensorflow_addons as tfa
 from resnet import ResNet50
-from resnet_amca import ResNetAMCA, AM_logits
+from resnet_amca import ResNetAMCA, AM_logits, BN_MODES, fused_call
 from utils import *
 import sys
 import os
@@ -24,12 +23,20 @@ def get_parser():
     parser.add_argument('--model_filters', type=int, default=64)
     parser.add_argument('--activation_fn', default='selu')
     parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--eval_batch_size', type=int, default=0)
+    parser.add_argument('--steps_per_execution', type=int, default=1)
+    parser.add_argument('--fuse_views', type=str2bool, nargs='?', default=False)
+    parser.add_argument('--bn_mode', type=str, default='domain', choices=BN_MODES)
     parser.add_argument('--num_classes', type=int, default=10)
     parser.add_argument('--train_src_days', type=int, default=3)
     parser.add_argument('--train_trg_days', type=int, default=0)
     parser.add_argument('--train_ser_days', type=int, default=0)
     parser.add_argument('--train_con_days', type=int, default=0)
     parser.add_argument('--train_off_days', type=int, default=0)
+    parser.add_argument('--shared_data', type=str2bool, nargs='?', default=False)
+    parser.add_argument('--storage', type=str, default='float32', choices=STORAGE_DTYPES)
+    parser.add_argument('--aug_workers', type=int, default=0)
+    parser.add_argument('--aug_ring_depth', type=int, default=4)
     parser.add_argument('--src_aug', type=int, default=0)
     parser.add_argument('--trgt_aug', type=int, default=0)
     parser.add_argument('--save_freq', type=int, default=25)
@@ -158,19 +165,26 @@ def get_model_class():
 @tf.function
 def train_step(src_data, trg_data, s, m, hp_lambda=0):
     src_images, src_labels = src_data
+    src_labels = tf.one_hot(src_labels, num_classes)
     # trg_images, trg_labels = trg_data
     (trgt_images_weak, trgt_images_strong), trg_labels = trg_data
 
     with tf.GradientTape() as tape:
-        src_logits = model(src_images,
-                            training=True,
-                            hp_lambda=hp_lambda)
-        trgt_weak_logits = model(trgt_images_weak,
-                            training=True,
-                            hp_lambda=hp_lambda)
-        trgt_strong_logits = model(trgt_images_strong,
-                            training=True,
-                            hp_lambda=hp_lambda)
+        if arg.fuse_views:
+            # one forward pass over [source, weak, strong]
+            src_logits, trgt_weak_logits, trgt_strong_logits = fused_call(
+                model, [src_images, trgt_images_weak, trgt_images_strong],
+                arg.bn_mode, training=True, hp_lambda=hp_lambda)
+        else:
+            src_logits = model(src_images,
+                                training=True,
+                                hp_lambda=hp_lambda)
+            trgt_weak_logits = model(trgt_images_weak,
+                                training=True,
+                                hp_lambda=hp_lambda)
+            trgt_strong_logits = model(trgt_images_strong,
+                                training=True,
+                                hp_lambda=hp_lambda)
 
         confidence = tf.constant(.97)
         pseudo_labels = tf.stop_gradient(tf.nn.softmax(trgt_weak_logits))
@@ -218,14 +232,12 @@ def train_step(src_data, trg_data, s, m, hp_lambda=0):
 
 
 def gen_dataset(x_data, y_data):
-    imgen_weak = tf.keras.preprocessing.image.ImageDataGenerator()
-    imgen_strong = tf.keras.preprocessing.image.ImageDataGenerator(
-        zoom_range=[.8, 1.2],
-        shear_range=5,
-        rotation_range=5,
-        preprocessing_function=preprocessing_function,
-    )
-    train_datasets.append(ImgGenAnchorDataset(imgen_weak, imgen_strong, x_data, y_data, batch_size=batch_size, u=1))
+    if arg.aug_workers > 0:
+        train_datasets.append(AugmentationPool(x_data, y_data, batch_size,
+                                               num_workers=arg.aug_workers,
+                                               depth=arg.aug_ring_depth))
+    else:
+        train_datasets.append(weak_strong_dataset(x_data, y_data, batch_size))
 
     # if arg.trgt_aug>0:
     #     train_datasets.append(imgen.flow(X_train_src, y_train_src, batch_size=batch_size))
@@ -247,6 +259,7 @@ if __name__ == '__main__':
     dataset_path = os.path.join(repo_path, 'data')
     num_classes = arg.num_classes
     batch_size = arg.batch_size
+    eval_batch_size = arg.eval_batch_size or batch_size
     train_src_days = arg.train_src_days
     train_ser_days = arg.train_ser_days
     train_con_days = arg.train_con_days
@@ -293,6 +306,16 @@ if __name__ == '__main__':
     del run_params['num_features']
     del run_params['model_filters']
     del run_params['batch_size']
+    del run_params['shared_data']
+    if arg.storage == 'float32':
+        del run_params['storage']
+    del run_params['eval_batch_size']
+    del run_params['steps_per_execution']
+    if not arg.fuse_views:
+        del run_params['fuse_views']
+        del run_params['bn_mode']
+    del run_params['aug_workers']
+    del run_params['aug_ring_depth']
     sorted(run_params)
 
     run_params = str(run_params).replace(" ",
@@ -307,148 +330,65 @@ if __name__ == '__main__':
 
     save_arg(arg)
     shutil.copy2(inspect.getfile(ResNetAMCA), arg.log_dir)
-    shutil.copy2(inspect.getfile(ImgGenAnchorDataset), arg.log_dir)
+    shutil.copy2(inspect.getfile(weak_strong_dataset), arg.log_dir)
     shutil.copy2(os.path.abspath(__file__), arg.log_dir)
     '''
     Data Preprocessing
     '''
-    X_data, y_data, classes = get_h5dataset(
-        os.path.join(dataset_path, 'source_data.h5'))
-    X_data, y_data = balance_dataset(X_data,
-                                        y_data,
-                                        num_days=10,
-                                        num_classes=len(classes),
-                                        max_samples_per_class=95)
-
-    # split days of data to train and test
-    X_src = X_data[y_data[:, 1] < train_src_days]
-    y_src = y_data[y_data[:, 1] < train_src_days, 0]
-    y_src = np.eye(len(classes))[y_src]
-    X_train_src, X_test_src, y_train_src, y_test_src = train_test_split(
-        X_src, y_src, stratify=y_src, test_size=0.10, random_state=42)
-
-    X_trg = X_data[y_data[:, 1] >= train_src_days]
-    y_trg = y_data[y_data[:, 1] >= train_src_days]
-    X_train_trg = X_trg[y_trg[:, 1] < train_src_days + train_trg_days]
-    y_train_trg = y_trg[y_trg[:, 1] < train_src_days + train_trg_days, 0]
-    y_train_trg = np.eye(len(classes))[y_train_trg]
-
-    X_test_trg = X_data[y_data[:, 1] >= train_src_days + train_trg_days]
-    y_test_trg = y_data[y_data[:, 1] >= train_src_days + train_trg_days, 0]
-    y_test_trg = np.eye(len(classes))[y_test_trg]
-
-    del X_src, y_src, X_trg, y_trg, X_data, y_data
-
-    # mean center and normalize dataset
-    X_train_src, src_mean = mean_center(X_train_src)
-    X_train_src, src_min, src_ptp = normalize(X_train_src)
-
-    X_test_src, _ = mean_center(X_test_src, src_mean)
-    X_test_src, _, _ = normalize(X_test_src, src_min, src_ptp)
-
-    if (X_train_trg.shape[0] != 0):
-        X_train_trg, trg_mean = mean_center(X_train_trg)
-        X_train_trg, trg_min, trg_ptp = normalize(X_train_trg)
-
-        X_test_trg, _ = mean_center(X_test_trg, trg_mean)
-        X_test_trg, _, _ = normalize(X_test_trg, trg_min, trg_ptp)
-    else:
-        X_test_trg, _ = mean_center(X_test_trg, src_mean)
-        X_test_trg, _, _ = normalize(X_test_trg, src_min, src_ptp)
-
-    X_train_src = X_train_src.astype(np.float32)
-    y_train_src = y_train_src.astype(np.uint8)
-    X_test_src = X_test_src.astype(np.float32)
-    y_test_src = y_test_src.astype(np.uint8)
-    X_train_trg = X_train_trg.astype(np.float32)
-    y_train_trg = y_train_trg.astype(np.uint8)
-    X_test_trg = X_test_trg.astype(np.float32)
-    y_test_trg = y_test_trg.astype(np.uint8)
-
-    X_train_conf, y_train_conf, X_test_conf, y_test_conf = get_trg_data(
-        os.path.join(dataset_path, 'target_conf_data.h5'), classes,
-        train_con_days, trgt_max=arg.trgt_max)
-    X_train_server, y_train_server, X_test_server, y_test_server = get_trg_data(
-        os.path.join(dataset_path, 'target_server_data.h5'), classes,
-        train_ser_days, trgt_max=arg.trgt_max)
-    X_train_office, y_train_office, X_data_office, y_data_office = get_trg_data(os.path.join(
-        dataset_path, 'target_office_data.h5'), classes,
-        train_off_days, trgt_max=arg.trgt_max)
+    X_train_src, y_train_src, X_test_src, y_test_src, \
+        X_train_trg, y_train_trg, X_test_trg, y_test_trg, classes = get_src_data(
+            os.path.join(dataset_path, 'source_data.h5'), train_src_days,
+            train_trg_days, shared=arg.shared_data, storage=arg.storage)
+
+    domains = TargetDomains(classes, trgt_max=arg.trgt_max, shared=arg.shared_data,
+                            storage=arg.storage)
+    domains.register('conference',
+                     os.path.join(dataset_path, 'target_conf_data.h5'),
+                     train_con_days)
+    domains.register('server',
+                     os.path.join(dataset_path, 'target_server_data.h5'),
+                     train_ser_days)
+    domains.register('office',
+                     os.path.join(dataset_path, 'target_office_data.h5'),
+                     train_off_days)
+    # only the adapted target domain is loaded up front, the rest stay on disk
+    domains.prefetch(*domains.trained())
 
     print("Final shapes: ")
     print(" Train Src:   ", X_train_src.shape, y_train_src.shape, "\n",
           "Test Src:    ", X_test_src.shape, y_test_src.shape, "\n",
           "Train Trg:   ", X_train_trg.shape, y_train_trg.shape, "\n",
           "Test Trg:    ", X_test_trg.shape, y_test_trg.shape)
-    print(" Train Conf:  ", X_train_conf.shape, y_train_conf.shape, "\n",
-          "Test Conf:   ", X_test_conf.shape, y_test_conf.shape, "\n",
-          "Train Server:", X_train_server.shape, y_train_server.shape, "\n",
-          "Test Server: ", X_test_server.shape, y_test_server.shape, "\n",
-          "Test office: ", X_data_office.shape, y_data_office.shape)
+    domains.summary()
 
     # get tf.data objects for each set
     # Test
-    conf_test_set = tf.data.Dataset.from_tensor_slices(
-        (X_test_conf, y_test_conf))
-    conf_test_set = conf_test_set.batch(batch_size, drop_remainder=False)
-    conf_test_set = conf_test_set.prefetch(batch_size)
-
-    server_test_set = tf.data.Dataset.from_tensor_slices(
-        (X_test_server, y_test_server))
-    server_test_set = server_test_set.batch(batch_size, drop_remainder=False)
-    server_test_set = server_test_set.prefetch(batch_size)
-
-    office_test_set = tf.data.Dataset.from_tensor_slices(
-        (X_data_office, y_data_office))
-    office_test_set = office_test_set.batch(batch_size, drop_remainder=False)
-    office_test_set = office_test_set.prefetch(batch_size)
-
-    src_test_set = tf.data.Dataset.from_tensor_slices((X_test_src, y_test_src))
-    src_test_set = src_test_set.batch(batch_size, drop_remainder=False)
-    src_test_set = src_test_set.prefetch(batch_size)
-
-    time_test_set = tf.data.Dataset.from_tensor_slices(
-        (X_test_trg, y_test_trg))
-    time_test_set = time_test_set.batch(batch_size, drop_remainder=False)
-    time_test_set = time_test_set.prefetch(batch_size)
+    src_test_set = array_dataset(X_test_src, y_test_src, eval_batch_size)
+    time_test_set = array_dataset(X_test_trg, y_test_trg, eval_batch_size)
 
     # Train
     train_datasets = []
 
-    if arg.src_aug > 0 or arg.trgt_aug > 0:
-        imgen = tf.keras.preprocessing.image.ImageDataGenerator(
-            zoom_range=[.8, 1.2],
-            shear_range=5,
-            rotation_range=5,
-            preprocessing_function=preprocessing_function,
-        )
-
-    if arg.src_aug > 0:
-        train_datasets.append(ImgGenDataset(imgen, X_train_src, y_train_src, batch_size=batch_size))
-
-    else:
-        src_train_set = tf.data.Dataset.from_tensor_slices(
-            (X_train_src, y_train_src))
-        src_train_set = src_train_set.shuffle(X_train_src.shape[0])
-        src_train_set = src_train_set.batch(batch_size, drop_remainder=True)
-        src_train_set = src_train_set.prefetch(batch_size)
-        train_datasets.append(src_train_set)
+    src_train_set = array_dataset(X_train_src, y_train_src, batch_size,
+                                  shuffle=True, drop_remainder=True,
+                                  map_fn=augment_batch if arg.src_aug > 0 else None)
+    train_datasets.append(src_train_set)
 
     if train_trg_days > 0:
         trgt_data = (X_train_trg, y_train_trg)
     if train_ser_days > 0:
-        trgt_data = (X_train_server, y_train_server)
+        trgt_data = domains.train('server')
     if train_con_days > 0:
-        trgt_data = (X_train_conf, y_train_conf)
+        trgt_data = domains.train('conference')
     if train_off_days > 0:
-        trgt_data = (X_train_office, y_train_office)
+        trgt_data = domains.train('office')
     gen_dataset(*trgt_data)
     '''
     Tensorflow Model
     '''
 
     source_train_acc = tf.keras.metrics.CategoricalAccuracy()
-    target_test_acc = tf.keras.metrics.CategoricalAccuracy()
+    evaluate = test_evaluator(test_step, num_classes)
 
     cross_entropy_loss = tf.keras.metrics.Mean()
     teacher_rate = tf.keras.metrics.Mean()
@@ -482,34 +422,31 @@ if __name__ == '__main__':
         y_test = y_test_trg
         name_trg_acc = "time test acc" + str(train_trg_days)
     elif train_ser_days > 0:
-        test_set = server_test_set
-        y_test = y_test_server
+        X_test, y_test = domains.test('server')
+        test_set = array_dataset(X_test, y_test, eval_batch_size)
         name_trg_acc = "server test acc" + str(train_ser_days)
     elif train_con_days > 0:
-        test_set = conf_test_set
-        y_test = y_test_conf
+        X_test, y_test = domains.test('conference')
+        test_set = array_dataset(X_test, y_test, eval_batch_size)
         name_trg_acc = "conference test acc" + str(train_con_days)
     elif train_off_days > 0:
-        test_set = office_test_set
-        y_test = y_data_office
+        X_test, y_test = domains.test('office')
+        test_set = array_dataset(X_test, y_test, eval_batch_size)
         name_trg_acc = "office test acc" + str(train_off_days)
 
-    batch_per_epoch = min(map(len, train_datasets))
+    train_set = MultiStepRunner(train_step, *train_datasets,
+                                steps_per_execution=arg.steps_per_execution)
     for epoch in range(epochs):
         m_anneal.assign(tf.minimum(m * (epoch / (epochs / anneal)), m))
         hp_lambda_anneal.assign(tf.minimum(epoch / (epochs / anneal), 1.0))
-        for datasets in zip(*train_datasets, range(batch_per_epoch)):
-            train_step(*datasets[:2], s, m_anneal, hp_lambda_anneal)
+        train_set.run(s, m_anneal, hp_lambda_anneal)
 
         if epoch % 5 == 0 or epoch == epochs-1:
-            pred_labels = []
-            for data in test_set:
-                pred_labels.extend(test_step(data[0]))
-            target_test_acc(pred_labels, y_test)
+            test_result = evaluate(test_set)
 
             with summary_writer.as_default():
                 tf.summary.scalar(name_trg_acc,
-                                  target_test_acc.result(),
+                                  test_result.accuracy,
                                   step=epoch)
                 tf.summary.scalar("source_train_acc",
                                   source_train_acc.result(),
@@ -517,14 +454,19 @@ if __name__ == '__main__':
                 tf.summary.scalar("teacher_rate",
                                   teacher_rate.result(),
                                   step=epoch)
+                if arg.aug_workers > 0:
+                    tf.summary.scalar("data_wait_time",
+                                      train_datasets[1].wait_time,
+                                      step=epoch)
 
         if (epoch + 1) % save_freq == 0:
             ckpt_save_path = ckpt_manager.save()
             print('Saved checkpoint for epoch {} at {}'.format(
                 epoch + 1, ckpt_save_path))
 
-        target_test_acc.reset_states()
         source_train_acc.reset_states()
+        if arg.aug_workers > 0:
+            train_datasets[1].reset_states()
 
     if save_freq != 0:
         ckpt_save_path = ckpt_manager.save()
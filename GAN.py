@@ -6,7 +6,6 @@ from utils import *
 from resnet_amca import ResNetAMCA, AM_logits
 from resnet import ResNet50
 import tensorflow as tf
-import numpy as np
 import argparse
 import inspect
 import shutil
@@ -23,12 +22,19 @@ def get_parser():
     parser.add_argument('--model_filters', type=int, default=64)
     parser.add_argument('--activation_fn', default='selu')
     parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--eval_batch_size', type=int, default=0)
+    parser.add_argument('--steps_per_execution', type=int, default=1)
+    parser.add_argument('--eval_every', type=int, default=1)
+    parser.add_argument('--async_eval', type=str2bool, nargs='?', default=False)
+    parser.add_argument('--eval_queue', type=int, default=1)
     parser.add_argument('--num_classes', type=int, default=10)
     parser.add_argument('--train_src_days', type=int, default=3)
     parser.add_argument('--train_trg_days', type=int, default=0)
     parser.add_argument('--train_ser_days', type=int, default=0)
     parser.add_argument('--train_con_days', type=int, default=0)
     parser.add_argument('--train_off_days', type=int, default=0)
+    parser.add_argument('--shared_data', type=str2bool, nargs='?', default=False)
+    parser.add_argument('--storage', type=str, default='float32', choices=STORAGE_DTYPES)
     parser.add_argument('--save_freq', type=int, default=25)
     parser.add_argument('--log_images_freq', type=int, default=25)
     parser.add_argument('--checkpoint_path', default="checkpoints")
@@ -58,10 +64,14 @@ def get_cross_entropy_loss(labels, logits):
     return tf.reduce_mean(loss)
 
 
+def predict(net, images):
+    logits, _ = net(images, training=False)
+    return tf.nn.softmax(logits)
+
+
 @tf.function
 def test_step(images):
-    logits, _ = model(images, training=False)
-    return tf.nn.softmax(logits)
+    return predict(model, images)
 
 
 class ResNetAMCADomClas(ResNet50):
@@ -112,6 +122,7 @@ class Discriminator(tf.keras.Model):
 @tf.function
 def train_step(src_data, srv_data, s, m, hp_lambda=0):
     src_images, src_labels = src_data
+    src_labels = tf.one_hot(src_labels, num_classes)
     srv_images, srv_labels = srv_data
 
     with tf.GradientTape() as tape, tf.GradientTape() as disc_tape:
@@ -159,12 +170,8 @@ def train_step(src_data, srv_data, s, m, hp_lambda=0):
     cross_entropy_loss(total_loss)
     domain_loss(batch_domain_loss)
 
-def write_acc(test_set, y_test):
-    test_acc = tf.keras.metrics.CategoricalAccuracy()
-    pred_labels = []
-    for data in test_set:
-        pred_labels.extend(test_step(data[0]))
-    acc = test_acc(pred_labels, y_test).numpy().item()
+def write_acc(test_set):
+    acc = float(evaluate(test_set).accuracy)
     print('acc=', acc)
 
     path_acc='./tools/acc_generator/logs'
@@ -175,11 +182,8 @@ def write_acc(test_set, y_test):
         f.write("  acc="+str(acc)+"\n") 
 
 def gen_dataset(x_data, y_data):
-    data_set = tf.data.Dataset.from_tensor_slices(
-        (x_data, y_data))
-    data_set = data_set.shuffle(x_data.shape[0])
-    data_set = data_set.batch(batch_size, drop_remainder=True)
-    data_set = data_set.prefetch(batch_size)
+    data_set = array_dataset(x_data, y_data, batch_size,
+                             shuffle=True, drop_remainder=True)
     train_datasets.append(data_set)
    
 
@@ -190,6 +194,7 @@ if __name__ == '__main__':
     dataset_path = os.path.join(repo_path, 'data')
     num_classes = arg.num_classes
     batch_size = arg.batch_size
+    eval_batch_size = arg.eval_batch_size or batch_size
     train_src_days = arg.train_src_days
     train_ser_days = arg.train_ser_days
     train_con_days = arg.train_con_days
@@ -232,6 +237,14 @@ if __name__ == '__main__':
     del run_params['checkpoint_path']
     del run_params['summary_writer_path']
     del run_params['save_freq']
+    del run_params['shared_data']
+    if arg.storage == 'float32':
+        del run_params['storage']
+    del run_params['eval_batch_size']
+    del run_params['steps_per_execution']
+    del run_params['eval_every']
+    del run_params['async_eval']
+    del run_params['eval_queue']
     sorted(run_params)
 
     run_params = str(run_params).replace(" ",
@@ -250,130 +263,58 @@ if __name__ == '__main__':
     '''
     Data Preprocessing
     '''
-    X_data, y_data, classes = get_h5dataset(
-        os.path.join(dataset_path, 'source_data.h5'))
-    X_data, y_data = balance_dataset(X_data,
-                                     y_data,
-                                     num_days=10,
-                                     num_classes=len(classes),
-                                     max_samples_per_class=95)
-
-    #split days of data to train and test
-    X_src = X_data[y_data[:, 1] < train_src_days]
-    y_src = y_data[y_data[:, 1] < train_src_days, 0]
-    y_src = np.eye(len(classes))[y_src]
-    X_train_src, X_test_src, y_train_src, y_test_src = train_test_split(
-        X_src, y_src, stratify=y_src, test_size=0.10, random_state=42)
-
-    X_trg = X_data[y_data[:, 1] >= train_src_days]
-    y_trg = y_data[y_data[:, 1] >= train_src_days]
-    X_train_trg = X_trg[y_trg[:, 1] < train_src_days + train_trg_days]
-    y_train_trg = y_trg[y_trg[:, 1] < train_src_days + train_trg_days, 0]
-    y_train_trg = np.eye(len(classes))[y_train_trg]
-
-    X_test_trg = X_data[y_data[:, 1] >= train_src_days + train_trg_days]
-    y_test_trg = y_data[y_data[:, 1] >= train_src_days + train_trg_days, 0]
-    y_test_trg = np.eye(len(classes))[y_test_trg]
-
-    del X_src, y_src, X_trg, y_trg, X_data, y_data
-
-    #mean center and normalize dataset
-    X_train_src, src_mean = mean_center(X_train_src)
-    X_train_src, src_min, src_ptp = normalize(X_train_src)
-
-    X_test_src, _ = mean_center(X_test_src, src_mean)
-    X_test_src, _, _ = normalize(X_test_src, src_min, src_ptp)
-
-    if (X_train_trg.shape[0] != 0):
-        X_train_trg, trg_mean = mean_center(X_train_trg)
-        X_train_trg, trg_min, trg_ptp = normalize(X_train_trg)
-
-        X_test_trg, _ = mean_center(X_test_trg, trg_mean)
-        X_test_trg, _, _ = normalize(X_test_trg, trg_min, trg_ptp)
-    else:
-        X_test_trg, _ = mean_center(X_test_trg, src_mean)
-        X_test_trg, _, _ = normalize(X_test_trg, src_min, src_ptp)
-
-    X_train_src = X_train_src.astype(np.float32)
-    y_train_src = y_train_src.astype(np.uint8)
-    X_test_src = X_test_src.astype(np.float32)
-    y_test_src = y_test_src.astype(np.uint8)
-    X_train_trg = X_train_trg.astype(np.float32)
-    y_train_trg = y_train_trg.astype(np.uint8)
-    X_test_trg = X_test_trg.astype(np.float32)
-    y_test_trg = y_test_trg.astype(np.uint8)
-
-    X_train_conf, y_train_conf, X_test_conf, y_test_conf = get_trg_data(
-        os.path.join(dataset_path, 'target_conf_data.h5'), classes,
-        train_con_days)
-    X_train_server, y_train_server, X_test_server, y_test_server = get_trg_data(
-        os.path.join(dataset_path, 'target_server_data.h5'), classes,
-        train_ser_days)
-    X_train_office, y_train_office, X_data_office, y_data_office = get_trg_data(os.path.join(
-        dataset_path, 'target_office_data.h5'), classes,
-        train_off_days)
+    X_train_src, y_train_src, X_test_src, y_test_src, \
+        X_train_trg, y_train_trg, X_test_trg, y_test_trg, classes = get_src_data(
+            os.path.join(dataset_path, 'source_data.h5'), train_src_days,
+            train_trg_days, shared=arg.shared_data, storage=arg.storage)
+
+    domains = TargetDomains(classes, shared=arg.shared_data,
+                            storage=arg.storage)
+    domains.register('conference',
+                     os.path.join(dataset_path, 'target_conf_data.h5'),
+                     train_con_days)
+    domains.register('server',
+                     os.path.join(dataset_path, 'target_server_data.h5'),
+                     train_ser_days)
+    domains.register('office',
+                     os.path.join(dataset_path, 'target_office_data.h5'),
+                     train_off_days)
+    # only the adapted target domain is loaded up front, the rest stay on disk
+    domains.prefetch(*domains.trained())
 
     print("Final shapes: ")
     print(" Train Src:   ", X_train_src.shape, y_train_src.shape, "\n",
           "Test Src:    ", X_test_src.shape, y_test_src.shape, "\n",
           "Train Trg:   ", X_train_trg.shape, y_train_trg.shape, "\n",
           "Test Trg:    ", X_test_trg.shape, y_test_trg.shape)
-    print(" Train Conf:  ", X_train_conf.shape, y_train_conf.shape, "\n",
-          "Test Conf:   ", X_test_conf.shape, y_test_conf.shape, "\n",
-          "Train Server:", X_train_server.shape, y_train_server.shape, "\n",
-          "Test Server: ", X_test_server.shape, y_test_server.shape, "\n",
-          "Test office: ", X_data_office.shape, y_data_office.shape)
+    domains.summary()
 
     #get tf.data objects for each set
     #Test
-    conf_test_set = tf.data.Dataset.from_tensor_slices(
-        (X_test_conf, y_test_conf))
-    conf_test_set = conf_test_set.batch(batch_size, drop_remainder=False)
-    conf_test_set = conf_test_set.prefetch(batch_size)
-
-    server_test_set = tf.data.Dataset.from_tensor_slices(
-        (X_test_server, y_test_server))
-    server_test_set = server_test_set.batch(batch_size, drop_remainder=False)
-    server_test_set = server_test_set.prefetch(batch_size)
-
-    office_test_set = tf.data.Dataset.from_tensor_slices(
-        (X_data_office, y_data_office))
-    office_test_set = office_test_set.batch(batch_size, drop_remainder=False)
-    office_test_set = office_test_set.prefetch(batch_size)
-
-    src_test_set = tf.data.Dataset.from_tensor_slices((X_test_src, y_test_src))
-    src_test_set = src_test_set.batch(batch_size, drop_remainder=False)
-    src_test_set = src_test_set.prefetch(batch_size)
-
-    time_test_set = tf.data.Dataset.from_tensor_slices(
-        (X_test_trg, y_test_trg))
-    time_test_set = time_test_set.batch(batch_size, drop_remainder=False)
-    time_test_set = time_test_set.prefetch(batch_size)
+    src_test_set = array_dataset(X_test_src, y_test_src, eval_batch_size)
+    time_test_set = array_dataset(X_test_trg, y_test_trg, eval_batch_size)
 
     #Train
     train_datasets = []
 
-    src_train_set = tf.data.Dataset.from_tensor_slices(
-        (X_train_src, y_train_src))
-    src_train_set = src_train_set.shuffle(X_train_src.shape[0])
-    src_train_set = src_train_set.batch(batch_size, drop_remainder=True)
-    src_train_set = src_train_set.prefetch(batch_size)
+    src_train_set = array_dataset(X_train_src, y_train_src, batch_size,
+                                  shuffle=True, drop_remainder=True)
     train_datasets.append(src_train_set)
 
     if train_trg_days > 0:
         gen_dataset(X_train_trg, y_train_trg)
     if train_ser_days > 0:
-        gen_dataset(X_train_server, y_train_server)
+        gen_dataset(*domains.train('server'))
     if train_con_days > 0:
-        gen_dataset(X_train_conf, y_train_conf)
+        gen_dataset(*domains.train('conference'))
     if train_off_days > 0:
-        gen_dataset(X_train_office, y_train_office)
+        gen_dataset(*domains.train('office'))
     '''
     Tensorflow Model
     '''
 
     source_train_acc = tf.keras.metrics.CategoricalAccuracy()
-    target_test_acc = tf.keras.metrics.CategoricalAccuracy()
+    evaluate = test_evaluator(test_step, num_classes)
 
     cross_entropy_loss = tf.keras.metrics.Mean()
     domain_loss = tf.keras.metrics.Mean()
@@ -383,11 +324,13 @@ if __name__ == '__main__':
         decay_steps=(X_train_src.shape[0] // batch_size) * 200,
         end_learning_rate=init_lr * 1e-2,
         cycle=True)
-    model = ResNetAMCADomClas(num_classes,
-                       num_features,
-                       num_filters=model_filters,
-                       activation=activation_fn,
-                       ca_decay=ca)
+    def new_model():
+        return ResNetAMCADomClas(num_classes,
+                                 num_features,
+                                 num_filters=model_filters,
+                                 activation=activation_fn,
+                                 ca_decay=ca)
+    model = new_model()
     disc = Discriminator(disc_hidden, num_domains, activation_fn)
 
     optimizer = tf.keras.optimizers.Adam(learning_rate=learning_rate)
@@ -407,46 +350,56 @@ if __name__ == '__main__':
         y_test = y_test_trg 
         name_trg_acc = "time test acc" + str(train_trg_days)
     elif train_ser_days > 0:
-        test_set = server_test_set
-        y_test = y_test_server 
+        X_test, y_test = domains.test('server')
+        test_set = array_dataset(X_test, y_test, eval_batch_size)
         name_trg_acc = "server test acc" + str(train_ser_days)
     elif train_con_days > 0:
-        test_set = conf_test_set
-        y_test = y_test_conf 
+        X_test, y_test = domains.test('conference')
+        test_set = array_dataset(X_test, y_test, eval_batch_size)
         name_trg_acc = "conference test acc" + str(train_con_days)
     elif train_off_days > 0:
-        test_set = office_test_set
-        y_test = y_data_office 
+        X_test, y_test = domains.test('office')
+        test_set = array_dataset(X_test, y_test, eval_batch_size)
         name_trg_acc = "office test acc" + str(train_off_days)
 
+    train_set = MultiStepRunner(train_step, *train_datasets,
+                                steps_per_execution=arg.steps_per_execution)
+    # the same test sets are scored with and without --async_eval
+    test_sets = {name_trg_acc: (test_set, y_test),
+                 "source test acc": (src_test_set, y_test_src)}
+    if arg.async_eval:
+        evaluator = AsyncEvaluator(model, new_model, predict, test_sets,
+                                   summary_writer, arg.eval_queue)
     for epoch in range(epochs):
         m_anneal.assign(tf.minimum(m * (epoch / (epochs / anneal)), m))
         hp_lambda_anneal.assign(tf.minimum(epoch / (epochs / anneal), 1.0))
-        for datasets in zip(*train_datasets):
-            train_step(*datasets, s, m_anneal, hp_lambda_anneal)
-
-        pred_labels = []
-        for data in test_set:
-            pred_labels.extend(test_step(data[0]))         
-        target_test_acc(pred_labels, y_test)
-
-        with summary_writer.as_default():
-            tf.summary.scalar(name_trg_acc,
-                              target_test_acc.result(),
-                              step=epoch)
-            tf.summary.scalar("source_train_acc",
-                              source_train_acc.result(),
-                              step=epoch)
+        train_set.run(s, m_anneal, hp_lambda_anneal)
+
+        if epoch % arg.eval_every == 0 or epoch == epochs-1:
+            if arg.async_eval:
+                evaluator.submit(epoch)
+            else:
+                test_results = {name: evaluate(data_set)
+                                for name, (data_set, _) in test_sets.items()}
+
+            with summary_writer.as_default():
+                if not arg.async_eval:
+                    for name, result in test_results.items():
+                        tf.summary.scalar(name, result.accuracy, step=epoch)
+                tf.summary.scalar("source_train_acc",
+                                  source_train_acc.result(),
+                                  step=epoch)
 
         # if (epoch + 1) % save_freq == 0:
         #     ckpt_save_path = ckpt_manager.save()
         #     print('Saved checkpoint for epoch {} at {}'.format(
         #         epoch + 1, ckpt_save_path))
 
-        target_test_acc.reset_states()
         source_train_acc.reset_states()
 
-    write_acc(test_set, y_test)
+    if arg.async_eval:
+        evaluator.close()
+    write_acc(test_set)
 
     if save_freq != 0:
         ckpt_save_path = ckpt_manager.save()
@@ -7,7 +7,7 @@ import argparse
 import numpy as np
 import tensorflow as tf
 from resnet import ResNet50
-from resnet_amca import ResNetAMCA, AM_logits
+from resnet_amca import ResNetAMCA, AM_logits, BN_MODES, fused_call
 from utils import *
 import sys
 import os
@@ -26,17 +26,36 @@ def get_parser():
     parser.add_argument('--model_filters', type=int, default=64)
     parser.add_argument('--activation_fn', default='selu')
     parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--eval_batch_size', type=int, default=0)
+    parser.add_argument('--steps_per_execution', type=int, default=1)
+    parser.add_argument('--eval_every', type=int, default=50)
+    parser.add_argument('--async_eval', type=str2bool, nargs='?', default=False)
+    parser.add_argument('--eval_queue', type=int, default=1)
+    parser.add_argument('--fuse_views', type=str2bool, nargs='?', default=False)
+    parser.add_argument('--bn_mode', type=str, default='domain', choices=BN_MODES)
     parser.add_argument('--num_classes', type=int, default=10)
     parser.add_argument('--train_src_days', type=int, default=3)
     parser.add_argument('--train_trg_days', type=int, default=0)
     parser.add_argument('--train_ser_days', type=int, default=0)
     parser.add_argument('--train_con_days', type=int, default=0)
     parser.add_argument('--train_off_days', type=int, default=0)
+    parser.add_argument('--shared_data', type=str2bool, nargs='?', default=False)
+    parser.add_argument('--storage', type=str, default='float32', choices=STORAGE_DTYPES)
+    parser.add_argument('--aug_workers', type=int, default=0)
+    parser.add_argument('--aug_ring_depth', type=int, default=4)
+    parser.add_argument('--aug_bank', type=int, default=0)
+    parser.add_argument('--aug_bank_dtype', default='float16')
     parser.add_argument('--val', type=str2bool, nargs='?', default=False)
     parser.add_argument('--src_aug', type=int, default=0)
     parser.add_argument('--trgt_aug', type=int, default=0)
     parser.add_argument('--confidence', type=float, default=.97)
+    parser.add_argument('--legacy_centroids', type=str2bool, nargs='?', default=False)
     parser.add_argument('--checkpoint_path', default="checkpoints")
+    parser.add_argument('--ckpt_every', type=int, default=0)
+    parser.add_argument('--ckpt_minutes', type=float, default=0)
+    parser.add_argument('--early_stop', type=int, default=0)
+    parser.add_argument('--min_delta', type=float, default=1e-3)
+    parser.add_argument('--probe_size', type=int, default=512)
     parser.add_argument('--anneal', type=int, default=4)
     parser.add_argument('--trgt_max', nargs='+')
     parser.add_argument('--s', type=int, default=10)
@@ -63,10 +82,14 @@ def get_cross_entropy_loss(labels, logits):
     return tf.reduce_mean(loss)
 
 
+def predict(net, images):
+    logits = net(images, training=False)
+    return tf.nn.softmax(logits)
+
+
 @tf.function
 def test_step(images):
-    logits = model(images, training=False)
-    return tf.nn.softmax(logits)
+    return predict(model, images)
 
 class ResNetAMCADomClas(ResNetAMCA):
     def __init__(self,
@@ -79,7 +102,7 @@ class ResNetAMCADomClas(ResNetAMCA):
         super().__init__(num_classes, num_features, num_filters, activation,
                         regularizer, dropout_rate)
         
-        self.emaCentroids = ExponentialMovingAverage(0.99)
+        self.emaCentroids = ExponentialMovingAverage(0.99, (num_classes, num_features))
 
     def call(self, x, training=False, output="logits"):
         x = self.conv1(x)
@@ -96,62 +119,65 @@ class ResNetAMCADomClas(ResNetAMCA):
             return fc1
         logits = self.logits(fc1)
         if output is "align_centroid" or output is "align_centroid_always":
-            centroids = self.get_feature_centroids(fc1, logits, output=="align_centroid")
-            cosinesim = tf.matmul(tf.nn.l2_normalize(centroids, -1),
-                    tf.nn.l2_normalize(self.logits.kernel, 0))
-            centroid_sim_logits = AM_logits(labels=cls_labels, logits=cosinesim, m=m, s=s)
-            return logits, centroid_sim_logits
+            return logits, self.centroid_logits(fc1, logits, output=="align_centroid")
         return logits
 
+    def centroid_logits(self, feature, logits, is_pseudo):
+        centroids = self.get_feature_centroids(feature, logits, is_pseudo)
+        cosinesim = tf.matmul(tf.nn.l2_normalize(centroids, -1),
+                tf.nn.l2_normalize(self.logits.kernel, 0))
+        return AM_logits(labels=cls_labels, logits=cosinesim, m=m, s=s)
+
     def get_feature_centroids(self, feature, logits, is_pseudo):
-        # centroid alignment
-        vetor_size = feature.shape[1]
+        # centroid alignment, mean of the (confident) features per predicted
+        # class from one segment sum over [feature, 1], classes without
+        # samples are masked out
         if is_pseudo:
             softmax_feature = tf.stop_gradient(tf.nn.softmax(logits, -1))
             mask_confidence = tf.reduce_max(softmax_feature, axis=1) >= arg.confidence
         else:
-            mask_confidence = tf.ones((feature.shape[0])) > 0
-        # avoid the case that there is no feature > threshold
-        if feature.shape is None:
-            class_centroids = tf.ones((self.num_classes, vetor_size))
-            mask_centroid = tf.zeros((self.num_classes, vetor_size))
-        else:
-            cls_idx = tf.math.argmax(logits, axis=1)
-            class_centroids = []
-            mask_centroid = []
-            for cls in range(self.num_classes):
-                mask_confidence_by_class = tf.math.logical_and(mask_confidence, cls_idx==cls)
-                centroid_by_class = tf.boolean_mask(feature, mask_confidence_by_class)
-                if centroid_by_class.shape[0] is None: # if no data in this class, mask out all
-                    class_centroids.append(tf.zeros(vetor_size))
-                    mask_centroid.append(tf.zeros(vetor_size))
-                else: # if there are some data in this class, take mean
-                    class_centroids.append(
-                        tf.math.reduce_sum(centroid_by_class, axis=0) / centroid_by_class.shape[0]
-                    )
-                    mask_centroid.append(tf.ones(vetor_size))
-            class_centroids = tf.stack(class_centroids)
-            mask_centroid = tf.stack(mask_centroid)
+            mask_confidence = tf.ones_like(feature[:, 0], dtype=tf.bool)
+        weights = tf.cast(mask_confidence, feature.dtype)[:, None]
+        cls_idx = tf.math.argmax(logits, axis=1, output_type=tf.int32)
+        sums = tf.math.unsorted_segment_sum(
+            tf.concat([feature, tf.ones_like(weights)], 1) * weights, cls_idx, self.num_classes)
+        counts = sums[:, -1:]
+        class_centroids = sums[:, :-1] / tf.maximum(counts, 1)
+        mask_centroid = tf.broadcast_to(tf.cast(counts > 0, feature.dtype),
+                                        tf.shape(class_centroids))
+        if arg.legacy_centroids:
+            # the boolean_mask version only saw unknown shapes in the graph and
+            # masked out every class, the EMA and the centroid loss stayed fixed
+            mask_centroid = tf.zeros_like(mask_centroid)
         return self.emaCentroids.apply(class_centroids, mask_centroid)
 
 
 @tf.function
 def train_step(src_data, trg_data, s, m):
     src_images, src_labels = src_data
+    src_labels = tf.one_hot(src_labels, num_classes)
     (trgt_images_weak, trgt_images_strong), trg_labels = trg_data
     with tf.GradientTape() as tape:
+        if arg.fuse_views:
+            # one forward pass over [source, weak, strong]
+            src_feature, trgt_weak_feature, trgt_strong_feature = fused_call(
+                model, [src_images, trgt_images_weak, trgt_images_strong],
+                arg.bn_mode, training=True, output="feature")
+            src_logits = model.logits(src_feature)
+        else:
+            src_logits = model(src_images, training=True)
+            trgt_weak_feature = model(trgt_images_weak,
+                                training=True, output = "feature")
+            trgt_strong_feature = model(trgt_images_strong,
+                                training=True, output = "feature")
+
         # supervised
-        src_logits = model(src_images, training=True)
         src_logits = AM_logits(
             labels=src_labels, logits=src_logits, m=m, s=s)
         batch_cross_entropy_loss = get_cross_entropy_loss(labels=src_labels,
                                                           logits=src_logits)
 
         # self supervised
-        trgt_weak_feature = model(trgt_images_weak,
-                            training=True, output = "feature")
-        trgt_strong_feature = model(trgt_images_strong,
-                            training=True, output = "feature")
 
         self_supervised_loss = cosine_similarity(trgt_weak_feature, trgt_strong_feature)
         self_supervised_loss = tf.reduce_mean(self_supervised_loss, axis=1)    
@@ -168,17 +194,31 @@ def train_step(src_data, trg_data, s, m):
 @tf.function 
 def train_step_seconstage(src_data, trg_data):
     src_images, src_labels = src_data
+    src_labels = tf.one_hot(src_labels, num_classes)
     (trgt_images_weak, trgt_images_strong), trg_labels = trg_data
 
     with tf.GradientTape() as tape:
-        src_logits, _ = model(src_images,
-                            training=True,
-                            output="align_centroid_always")
-        trgt_weak_logits, trgt_weak_centroid_sim_logits = model(trgt_images_weak,
-                                                        training=True,
-                                                        output="align_centroid")
-        trgt_strong_logits = model(trgt_images_strong,
-                            training=True)
+        if arg.fuse_views:
+            # one forward pass over [source, weak, strong], the centroids are
+            # updated from the source and then the weak target features
+            src_feature, trgt_weak_feature, trgt_strong_feature = fused_call(
+                model, [src_images, trgt_images_weak, trgt_images_strong],
+                arg.bn_mode, training=True, output="feature")
+            src_logits = model.logits(src_feature)
+            trgt_weak_logits = model.logits(trgt_weak_feature)
+            trgt_strong_logits = model.logits(trgt_strong_feature)
+            model.centroid_logits(src_feature, src_logits, False)
+            trgt_weak_centroid_sim_logits = model.centroid_logits(
+                trgt_weak_feature, trgt_weak_logits, True)
+        else:
+            src_logits, _ = model(src_images,
+                                training=True,
+                                output="align_centroid_always")
+            trgt_weak_logits, trgt_weak_centroid_sim_logits = model(trgt_images_weak,
+                                                            training=True,
+                                                            output="align_centroid")
+            trgt_strong_logits = model(trgt_images_strong,
+                                training=True)
 
         # amca:
         src_logits = AM_logits(
@@ -211,33 +251,46 @@ def train_step_seconstage(src_data, trg_data):
         loss_centroid = tf.reduce_mean(loss_centroid)
 
         total_loss = batch_cross_entropy_loss + 0.05*loss_centroid + loss_xeu
-        seconstage_correct_rate(tf.math.equal(to_one_hot(pseudo_labels, 10), trg_labels))
+        seconstage_correct_rate(tf.math.equal(to_one_hot(pseudo_labels, 10),
+                                              tf.one_hot(trg_labels, 10, dtype=tf.uint8)))
 
     gradients = tape.gradient(total_loss, model.trainable_variables)
     optimizer.apply_gradients(zip(gradients, model.trainable_variables))
     teacher_rate(pseudo_mask)
+    cross_entropy_loss(batch_cross_entropy_loss)
+
 
+def stage_converged(monitor, probe, epoch, **signals):
+    # label-free signals, validation accuracy only on the --val split (and
+    # only when it is scored in the training loop)
+    if arg.val and not arg.async_eval:
+        signals['val_acc'] = (test_results[name_trg_acc].accuracy, 'max')
+    signals.update(probe())
+    return monitor.update(epoch, **signals)
+
+
+def gen_bank(x_data, y_data, weak_strong=False):
+    bank = augmentation_bank(os.path.join(arg.log_dir, 'aug_bank'), x_data,
+                             arg.aug_bank, dtype=arg.aug_bank_dtype)
+    return bank_dataset(x_data, y_data, bank, batch_size, weak_strong=weak_strong)
 
 def gen_dataset(x_data, y_data):
-    if arg.trgt_aug>0:
-        train_datasets.append(ImgGenDataset(imgen, x_data, y_data, batch_size=batch_size))
-    else:
-        data_set = tf.data.Dataset.from_tensor_slices(
-            (x_data, y_data))
-        data_set = data_set.shuffle(x_data.shape[0])
-        data_set = data_set.batch(batch_size, drop_remainder=True)
-        data_set = data_set.prefetch(batch_size)
-        train_datasets.append(data_set)
+    if arg.trgt_aug > 0 and arg.aug_bank > 0:
+        train_datasets.append(gen_bank(x_data, y_data))
+        return
+    data_set = array_dataset(x_data, y_data, batch_size,
+                             shuffle=True, drop_remainder=True,
+                             map_fn=augment_batch if arg.trgt_aug > 0 else None)
+    train_datasets.append(data_set)
 
 def gen_weak_strong(x_data, y_data):
-    imgen_weak = tf.keras.preprocessing.image.ImageDataGenerator()
-    imgen_strong = tf.keras.preprocessing.image.ImageDataGenerator(
-        zoom_range=[.8, 1.2],
-        shear_range=5,
-        rotation_range=5,
-        preprocessing_function=preprocessing_function,
-    )
-    return ImgGenAnchorDataset(imgen_weak, imgen_strong, x_data, y_data, batch_size=batch_size, u=1)
+    if arg.aug_bank > 0:
+        return gen_bank(x_data, y_data, weak_strong=True)
+    if arg.aug_workers > 0:
+        return AugmentationPool(x_data, y_data, batch_size,
+                                num_workers=arg.aug_workers,
+                                depth=arg.aug_ring_depth)
+    return weak_strong_dataset(x_data, y_data, batch_size)
 
 
 if __name__ == '__main__':
@@ -247,6 +300,7 @@ if __name__ == '__main__':
     dataset_path = os.path.join(repo_path, 'data')
     num_classes = arg.num_classes
     batch_size = arg.batch_size
+    eval_batch_size = arg.eval_batch_size or batch_size
     train_src_days = arg.train_src_days
     train_ser_days = arg.train_ser_days
     train_con_days = arg.train_con_days
@@ -292,6 +346,12 @@ if __name__ == '__main__':
     del run_params['confidence']
     del run_params['log_dir']
     del run_params['checkpoint_path']
+    del run_params['ckpt_every']
+    del run_params['ckpt_minutes']
+    if arg.early_stop == 0:
+        del run_params['early_stop']
+        del run_params['min_delta']
+        del run_params['probe_size']
     del run_params['init_lr']
     del run_params['num_features']
     del run_params['model_filters']
@@ -299,6 +359,24 @@ if __name__ == '__main__':
     del run_params['trgt_max']
     del run_params['epochs_2stage']
     del run_params['notes_2stage']
+    del run_params['shared_data']
+    if arg.storage == 'float32':
+        del run_params['storage']
+    del run_params['eval_batch_size']
+    del run_params['steps_per_execution']
+    del run_params['eval_every']
+    del run_params['async_eval']
+    del run_params['eval_queue']
+    if not arg.fuse_views:
+        del run_params['fuse_views']
+        del run_params['bn_mode']
+    del run_params['aug_workers']
+    del run_params['aug_ring_depth']
+    del run_params['aug_bank_dtype']
+    if arg.aug_bank == 0:
+        del run_params['aug_bank']
+    if not arg.legacy_centroids:
+        del run_params['legacy_centroids']
     sorted(run_params)
 
     run_params = str(run_params).replace(" ",
@@ -322,139 +400,61 @@ if __name__ == '__main__':
     '''
     Data Preprocessing
     '''
-    X_data, y_data, classes = get_h5dataset(
-        os.path.join(dataset_path, 'source_data.h5'))
-    X_data, y_data = balance_dataset(X_data,
-                                        y_data,
-                                        num_days=10,
-                                        num_classes=len(classes),
-                                        max_samples_per_class=95)
-
-    # split days of data to train and test
-    X_src = X_data[y_data[:, 1] < train_src_days]
-    y_src = y_data[y_data[:, 1] < train_src_days, 0]
-    y_src = np.eye(len(classes))[y_src]
-    X_train_src, X_test_src, y_train_src, y_test_src = train_test_split(
-        X_src, y_src, stratify=y_src, test_size=0.10, random_state=42)
-
-    X_trg = X_data[y_data[:, 1] >= train_src_days]
-    y_trg = y_data[y_data[:, 1] >= train_src_days]
-    X_train_trg = X_trg[y_trg[:, 1] < train_src_days + train_trg_days]
-    y_train_trg = y_trg[y_trg[:, 1] < train_src_days + train_trg_days, 0]
-    y_train_trg = np.eye(len(classes))[y_train_trg]
-
-    X_test_trg = X_data[y_data[:, 1] >= train_src_days + train_trg_days]
-    y_test_trg = y_data[y_data[:, 1] >= train_src_days + train_trg_days, 0]
-    y_test_trg = np.eye(len(classes))[y_test_trg]
-
-    del X_src, y_src, X_trg, y_trg, X_data, y_data
-
-    # mean center and normalize dataset
-    X_train_src, src_mean = mean_center(X_train_src)
-    X_train_src, src_min, src_ptp = normalize(X_train_src)
-
-    X_test_src, _ = mean_center(X_test_src, src_mean)
-    X_test_src, _, _ = normalize(X_test_src, src_min, src_ptp)
-
-    if (X_train_trg.shape[0] != 0):
-        X_train_trg, trg_mean = mean_center(X_train_trg)
-        X_train_trg, trg_min, trg_ptp = normalize(X_train_trg)
-
-        X_test_trg, _ = mean_center(X_test_trg, trg_mean)
-        X_test_trg, _, _ = normalize(X_test_trg, trg_min, trg_ptp)
-    else:
-        X_test_trg, _ = mean_center(X_test_trg, src_mean)
-        X_test_trg, _, _ = normalize(X_test_trg, src_min, src_ptp)
-
-    X_train_src = X_train_src.astype(np.float32)
-    y_train_src = y_train_src.astype(np.uint8)
-    X_test_src = X_test_src.astype(np.float32)
-    y_test_src = y_test_src.astype(np.uint8)
-    X_train_trg = X_train_trg.astype(np.float32)
-    y_train_trg = y_train_trg.astype(np.uint8)
-    X_test_trg = X_test_trg.astype(np.float32)
-    y_test_trg = y_test_trg.astype(np.uint8)
-
-    X_train_conf, y_train_conf, X_test_conf, y_test_conf = get_trg_data(
-        os.path.join(dataset_path, 'target_conf_data.h5'), classes,
-        train_con_days, trgt_max=arg.trgt_max)
-    X_train_server, y_train_server, X_test_server, y_test_server = get_trg_data(
-        os.path.join(dataset_path, 'target_server_data.h5'), classes,
-        train_ser_days, trgt_max=arg.trgt_max)
-    X_train_office, y_train_office, X_data_office, y_data_office = get_trg_data(os.path.join(
-        dataset_path, 'target_office_data.h5'), classes,
-        train_off_days, trgt_max=arg.trgt_max)
+    X_train_src, y_train_src, X_test_src, y_test_src, \
+        X_train_trg, y_train_trg, X_test_trg, y_test_trg, classes = get_src_data(
+            os.path.join(dataset_path, 'source_data.h5'), train_src_days,
+            train_trg_days, shared=arg.shared_data, storage=arg.storage)
+
+    domains = TargetDomains(classes, trgt_max=arg.trgt_max, shared=arg.shared_data,
+                            storage=arg.storage)
+    domains.register('conference',
+                     os.path.join(dataset_path, 'target_conf_data.h5'),
+                     train_con_days)
+    domains.register('server',
+                     os.path.join(dataset_path, 'target_server_data.h5'),
+                     train_ser_days)
+    domains.register('office',
+                     os.path.join(dataset_path, 'target_office_data.h5'),
+                     train_off_days)
+    # only the adapted target domain is loaded up front, the rest stay on disk
+    domains.prefetch(*domains.trained())
 
     print("Final shapes: ")
     print(" Train Src:   ", X_train_src.shape, y_train_src.shape, "\n",
           "Test Src:    ", X_test_src.shape, y_test_src.shape, "\n",
           "Train Trg:   ", X_train_trg.shape, y_train_trg.shape, "\n",
           "Test Trg:    ", X_test_trg.shape, y_test_trg.shape)
-    print(" Train Conf:  ", X_train_conf.shape, y_train_conf.shape, "\n",
-          "Test Conf:   ", X_test_conf.shape, y_test_conf.shape, "\n",
-          "Train Server:", X_train_server.shape, y_train_server.shape, "\n",
-          "Test Server: ", X_test_server.shape, y_test_server.shape, "\n",
-          "Test office: ", X_data_office.shape, y_data_office.shape)
+    domains.summary()
 
     # get tf.data objects for each set
     # Test
-    conf_test_set = tf.data.Dataset.from_tensor_slices(
-        (X_test_conf, y_test_conf))
-    conf_test_set = conf_test_set.batch(batch_size, drop_remainder=False)
-    conf_test_set = conf_test_set.prefetch(batch_size)
-
-    server_test_set = tf.data.Dataset.from_tensor_slices(
-        (X_test_server, y_test_server))
-    server_test_set = server_test_set.batch(batch_size, drop_remainder=False)
-    server_test_set = server_test_set.prefetch(batch_size)
-
-    office_test_set = tf.data.Dataset.from_tensor_slices(
-        (X_data_office, y_data_office))
-    office_test_set = office_test_set.batch(batch_size, drop_remainder=False)
-    office_test_set = office_test_set.prefetch(batch_size)
-
-    src_test_set = tf.data.Dataset.from_tensor_slices((X_test_src, y_test_src))
-    src_test_set = src_test_set.batch(batch_size, drop_remainder=False)
-    src_test_set = src_test_set.prefetch(batch_size)
-
-    time_test_set = tf.data.Dataset.from_tensor_slices(
-        (X_test_trg, y_test_trg))
-    time_test_set = time_test_set.batch(batch_size, drop_remainder=False)
-    time_test_set = time_test_set.prefetch(batch_size)
+    src_test_set = array_dataset(X_test_src, y_test_src, eval_batch_size)
+    time_test_set = array_dataset(X_test_trg, y_test_trg, eval_batch_size)
 
     # Train
     train_datasets = []
 
-    if arg.src_aug > 0 or arg.trgt_aug > 0:
-        imgen = tf.keras.preprocessing.image.ImageDataGenerator(
-            zoom_range=[.8, 1.2],
-            shear_range=5,
-            rotation_range=5,
-            preprocessing_function=preprocessing_function,
-        )
-
-    if arg.src_aug > 0:
-        train_datasets.append(ImgGenDataset(imgen, X_train_src, y_train_src, batch_size=batch_size))
+    if arg.src_aug > 0 and arg.aug_bank > 0:
+        src_train_set = gen_bank(X_train_src, y_train_src)
     else:
-        src_train_set = tf.data.Dataset.from_tensor_slices(
-            (X_train_src, y_train_src))
-        src_train_set = src_train_set.shuffle(X_train_src.shape[0])
-        src_train_set = src_train_set.batch(batch_size, drop_remainder=True)
-        src_train_set = src_train_set.prefetch(batch_size)
-        train_datasets.append(src_train_set)
+        src_train_set = array_dataset(X_train_src, y_train_src, batch_size,
+                                      shuffle=True, drop_remainder=True,
+                                      map_fn=augment_batch if arg.src_aug > 0 else None)
+    train_datasets.append(src_train_set)
 
     if train_trg_days > 0:
         trgt_data = (X_train_trg, y_train_trg)
     if train_ser_days > 0:
-        trgt_data = (X_train_server, y_train_server)
+        trgt_data = domains.train('server')
     if train_con_days > 0:
-        trgt_data = (X_train_conf, y_train_conf)
+        trgt_data = domains.train('conference')
     if train_off_days > 0:
-        trgt_data = (X_train_office, y_train_office)
+        trgt_data = domains.train('office')
        
     if arg.val:
         X_train_trg_splt, X_test_trg_splt, y_train_trg_splt, y_test_trg_splt = train_test_split(
-            trgt_data[0], trgt_data[1], stratify=trgt_data[1], test_size=0.3333, random_state=42)
+            trgt_data[0], trgt_data[1], stratify=np.eye(num_classes, dtype=np.uint8)[trgt_data[1]],
+            test_size=0.3333, random_state=42)
         trgt_data = (X_train_trg_splt, y_train_trg_splt)
     gen_dataset(*trgt_data)
     '''
@@ -462,7 +462,7 @@ if __name__ == '__main__':
     '''
 
     source_train_acc = tf.keras.metrics.CategoricalAccuracy()
-    target_test_acc = tf.keras.metrics.CategoricalAccuracy()
+    evaluate = test_evaluator(test_step, num_classes)
 
     cross_entropy_loss = tf.keras.metrics.Mean()
     domain_loss = tf.keras.metrics.Mean()
@@ -474,10 +474,12 @@ if __name__ == '__main__':
         decay_steps=(X_train_src.shape[0] // batch_size) * 200,
         end_learning_rate=init_lr * 1e-2,
         cycle=True)
-    model = ResNetAMCADomClas(num_classes,
-                              num_features,
-                              num_filters=model_filters,
-                              activation=activation_fn)
+    def new_model():
+        return ResNetAMCADomClas(num_classes,
+                                 num_features,
+                                 num_filters=model_filters,
+                                 activation=activation_fn)
+    model = new_model()
     optimizer = tf.keras.optimizers.Adam(learning_rate=learning_rate)
 
     ckpt = tf.train.Checkpoint(model=model)
@@ -489,9 +491,7 @@ if __name__ == '__main__':
     m_anneal = tf.Variable(0, dtype="float32")
 
     if arg.val:
-        test_set = tf.data.Dataset.from_tensor_slices((X_test_trg_splt, y_test_trg_splt))
-        test_set = test_set.batch(batch_size, drop_remainder=False)
-        test_set = test_set.prefetch(batch_size)
+        test_set = array_dataset(X_test_trg_splt, y_test_trg_splt, eval_batch_size)
         y_test = y_test_trg_splt
         name_trg_acc = "val"
     elif train_trg_days > 0:
@@ -499,49 +499,77 @@ if __name__ == '__main__':
         y_test = y_test_trg
         name_trg_acc = "time test acc" + str(train_trg_days)
     elif train_ser_days > 0:
-        test_set = server_test_set
-        y_test = y_test_server
+        X_test, y_test = domains.test('server')
+        test_set = array_dataset(X_test, y_test, eval_batch_size)
         name_trg_acc = "server test acc" + str(train_ser_days)
     elif train_con_days > 0:
-        test_set = conf_test_set
-        y_test = y_test_conf
+        X_test, y_test = domains.test('conference')
+        test_set = array_dataset(X_test, y_test, eval_batch_size)
         name_trg_acc = "conference test acc" + str(train_con_days)
     elif train_off_days > 0:
-        test_set = office_test_set
-        y_test = y_data_office
+        X_test, y_test = domains.test('office')
+        test_set = array_dataset(X_test, y_test, eval_batch_size)
         name_trg_acc = "office test acc" + str(train_off_days)
 
+    # the same test sets are scored with and without --async_eval
+    test_sets = {name_trg_acc: (test_set, y_test),
+                 "source test acc": (src_test_set, y_test_src)}
+
     # weak strong dataset
     weak_strong_ds = gen_weak_strong(*trgt_data)
-    seconstage_train_dataset = [train_datasets[0], weak_strong_ds]        
-    batch_per_epoch = min(map(len, seconstage_train_dataset))
+    firststage_runner = MultiStepRunner(train_step, train_datasets[0], weak_strong_ds,
+                                        steps_per_execution=arg.steps_per_execution)
+    if arg.early_stop > 0:
+        # one probe copy of the target inputs, shared by both stages
+        probe = PredictionProbe(test_step, trgt_data[0], arg.probe_size, eval_batch_size)
     print('___ckpt_manager.latest_checkpoint:', ckpt_manager.latest_checkpoint)
     if ckpt_manager.latest_checkpoint:
         print('--- LOAD CHECKPOINT ---')
     else:
         summary_writer = tf.summary.create_file_writer(summary_writer_path)
-        for epoch in tqdm(range(epochs)):
+        # mid-stage checkpoints, the finished stage is saved by ckpt_manager
+        resume = PeriodicCheckpoint(os.path.join(checkpoint_path, 'resume'),
+                                    arg.ckpt_every, arg.ckpt_minutes,
+                                    model=model, optimizer=optimizer,
+                                    seeds=seed_generators(train_datasets[0], weak_strong_ds))
+        if arg.early_stop > 0:
+            monitor = ConvergenceMonitor(arg.early_stop, arg.min_delta)
+        converged = False
+        if arg.async_eval:
+            evaluator = AsyncEvaluator(model, new_model, predict, test_sets,
+                                       summary_writer, arg.eval_queue)
+        for epoch in tqdm(range(resume.restore(), epochs)):
             m_anneal.assign(tf.minimum(m * (epoch / (epochs / anneal)), m))
-            for datasets in zip(*seconstage_train_dataset, range(batch_per_epoch)):
-                train_step(*datasets[:2], s, m_anneal)
+            firststage_runner.run(s, m_anneal)
 
-            if epoch % 50 == 0 or epoch == epochs-1:
-                pred_labels = []
-                for data in test_set:
-                    pred_labels.extend(test_step(data[0]))
-                target_test_acc(pred_labels, y_test)
+            if epoch % arg.eval_every == 0 or epoch == epochs-1:
+                if arg.async_eval:
+                    evaluator.submit(epoch)
+                else:
+                    test_results = {name: evaluate(data_set)
+                                    for name, (data_set, _) in test_sets.items()}
 
                 with summary_writer.as_default():
-                    tf.summary.scalar(name_trg_acc,
-                                    target_test_acc.result(),
-                                    step=epoch)
+                    if not arg.async_eval:
+                        for name, result in test_results.items():
+                            tf.summary.scalar(name, result.accuracy, step=epoch)
                     tf.summary.scalar("source_train_acc",
                                     source_train_acc.result(),
                                     step=epoch)
+                    if arg.early_stop > 0:
+                        converged = stage_converged(
+                            monitor, probe, epoch,
+                            source_loss=(cross_entropy_loss.result(), 'min'))
 
-            target_test_acc.reset_states()
             source_train_acc.reset_states()
-            
+            cross_entropy_loss.reset_states()
+            resume.step(epoch)
+            if converged:
+                break
+
+        if arg.async_eval:
+            evaluator.close()
+        resume.wait()
         ckpt_save_path = ckpt_manager.save()
         print('Saved checkpoint at {}'.format(ckpt_save_path))
 
@@ -553,10 +581,7 @@ if __name__ == '__main__':
     optimizer = tf.keras.optimizers.Adam(learning_rate=learning_rate)
 
 
-    pretrain_model = ResNetAMCADomClas(num_classes,
-                                    num_features,
-                                    num_filters=model_filters,
-                                    activation=activation_fn)
+    pretrain_model = new_model()
     load(checkpoint_path, model=pretrain_model)
 
 
@@ -568,30 +593,60 @@ if __name__ == '__main__':
     ckpt2.restore(ckpt_manager2.latest_checkpoint).expect_partial()
 
     cls_labels = tf.range(0, 10)
-    for epoch in range(arg.epochs_2stage):
-        epoch += epochs
-        for datasets in zip(*seconstage_train_dataset, range(batch_per_epoch)):
-            train_step_seconstage(*datasets[:2])
-
-        if epoch % 50 == 0 or epoch == epochs-1:
-            pred_labels = []
-            for data in test_set:
-                pred_labels.extend(test_step(data[0]))
-            target_test_acc(pred_labels, y_test)
+    seconstage_runner = MultiStepRunner(train_step_seconstage,
+                                        train_datasets[0], weak_strong_ds,
+                                        steps_per_execution=arg.steps_per_execution)
+    resume2 = PeriodicCheckpoint(os.path.join(checkpoint_path2, 'resume'),
+                                 arg.ckpt_every, arg.ckpt_minutes,
+                                 model=model, optimizer=optimizer,
+                                 seeds=seed_generators(train_datasets[0], weak_strong_ds))
+    if arg.early_stop > 0:
+        monitor = ConvergenceMonitor(arg.early_stop, arg.min_delta)
+        probe.reset()
+    converged = False
+    if arg.async_eval:
+        evaluator = AsyncEvaluator(model, new_model, predict, test_sets,
+                                   summary_writer, arg.eval_queue)
+    for epoch in range(resume2.restore(epochs), epochs + arg.epochs_2stage):
+        seconstage_runner.run()
+
+        if epoch % arg.eval_every == 0 or epoch == epochs-1:
+            if arg.async_eval:
+                evaluator.submit(epoch)
+            else:
+                test_results = {name: evaluate(data_set)
+                                for name, (data_set, _) in test_sets.items()}
 
             with summary_writer.as_default():
-                tf.summary.scalar(name_trg_acc,
-                                  target_test_acc.result(),
-                                  step=epoch)
+                if not arg.async_eval:
+                    for name, result in test_results.items():
+                        tf.summary.scalar(name, result.accuracy, step=epoch)
                 tf.summary.scalar("teacher_rate",
                                   teacher_rate.result(),
                                   step=epoch)
                 tf.summary.scalar("seconstage_correct_rate",
                                   seconstage_correct_rate.result(),
                                   step=epoch)
-        target_test_acc.reset_states()
+                if isinstance(weak_strong_ds, AugmentationPool):
+                    tf.summary.scalar("data_wait_time",
+                                      weak_strong_ds.wait_time,
+                                      step=epoch)
+                if arg.early_stop > 0:
+                    converged = stage_converged(
+                        monitor, probe, epoch,
+                        source_loss=(cross_entropy_loss.result(), 'min'),
+                        teacher_rate=(teacher_rate.result(), 'max'))
         teacher_rate.reset_states()
         seconstage_correct_rate.reset_states()
-    
+        cross_entropy_loss.reset_states()
+        if isinstance(weak_strong_ds, AugmentationPool):
+            weak_strong_ds.reset_states()
+        resume2.step(epoch, force=converged or epoch == epochs + arg.epochs_2stage - 1)
+        if converged:
+            break
+
+    if arg.async_eval:
+        evaluator.close()
+    resume2.wait()
     ckpt_save_path2 = ckpt_manager2.save()
     print('Saved final checkpoint at {}'.format(ckpt_save_path2))
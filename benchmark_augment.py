@@ -0,0 +1,71 @@
+import time
+from utils import *
+import tensorflow as tf
+import numpy as np
+import argparse
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description='Augmentation throughput, ImageDataGenerator vs tf.data')
+    parser.add_argument('--num_samples', type=int, default=2048)
+    parser.add_argument('--image_size', type=int, default=256)
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--epochs', type=int, default=3)
+    return parser
+
+
+def max_diff(height, width, num_samples=8):
+    # affine_transform against ImageDataGenerator on the same parameters
+    x = np.random.uniform(-1, 1, (num_samples, height, width, 1)).astype(np.float32)
+    theta, shear = np.random.uniform(-5, 5, (2, num_samples)).astype(np.float32)
+    zx, zy = np.random.uniform(.8, 1.2, (2, num_samples)).astype(np.float32)
+    ref = np.stack([tf.keras.preprocessing.image.apply_affine_transform(
+        x[i], theta=theta[i], shear=shear[i], zx=zx[i], zy=zy[i],
+        row_axis=0, col_axis=1, channel_axis=2, fill_mode='nearest', order=1)
+        for i in range(num_samples)])
+    return np.abs(affine_transform(x, theta, shear, zx, zy).numpy() - ref).max()
+
+
+def run(data_set, steps):
+    # first batch builds the pipeline, keep it out of the timing
+    data_iter = iter(data_set)
+    next(data_iter)
+    start = time.perf_counter()
+    for _ in range(steps - 1):
+        x, y = next(data_iter)
+    return (steps - 1) / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    parser = get_parser()
+    arg = parser.parse_args()
+
+    batch_size = arg.batch_size
+    X_data = np.random.uniform(-1, 1, (arg.num_samples, arg.image_size,
+                                       arg.image_size, 1)).astype(np.float32)
+    y_data = np.random.randint(0, 10, arg.num_samples).astype(np.int32)
+    steps = arg.epochs * (arg.num_samples // batch_size)
+
+    imgen = tf.keras.preprocessing.image.ImageDataGenerator(
+        zoom_range=[.8, 1.2],
+        shear_range=5,
+        rotation_range=5,
+        preprocessing_function=preprocessing_function,
+    )
+    imgen_rate = run(ImgGenDataset(imgen, X_data, y_data, batch_size=batch_size),
+                     steps)
+
+    data_set = array_dataset(X_data, y_data, batch_size,
+                             shuffle=True, drop_remainder=True,
+                             map_fn=augment_batch).repeat()
+    tfdata_rate = run(data_set, steps)
+
+    print("ImageDataGenerator: {:8.2f} batches/s".format(imgen_rate))
+    print("tf.data:            {:8.2f} batches/s".format(tfdata_rate))
+    print("speedup:            {:8.2f}x".format(tfdata_rate / imgen_rate))
+
+    size = arg.image_size
+    for height, width in [(size, size), (size, size // 2), (size // 2, size)]:
+        print("max abs diff {:4d}x{:<4d}: {:.2e}".format(
+            height, width, max_diff(height, width)))
@@ -0,0 +1,29 @@
+import os
+import argparse
+from utils import *
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description='Export h5 domain files to sharded TFRecords')
+    parser.add_argument('--out_dir', type=str, required=True)
+    parser.add_argument('--num_shards', type=int, default=16)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--chunk_size', type=int, default=1024,
+                        help='samples read from the h5 file at once')
+    parser.add_argument('files', nargs='*',
+                        default=['source_data.h5', 'target_conf_data.h5',
+                                 'target_server_data.h5', 'target_office_data.h5'])
+    return parser
+
+
+if __name__ == '__main__':
+    parser = get_parser()
+    arg = parser.parse_args()
+
+    dataset_path = os.path.join(os.getenv('MMWAVE_PATH'), 'data')
+    for filename in arg.files:
+        meta_file = export_shards(os.path.join(dataset_path, filename), arg.out_dir,
+                                  arg.num_shards, seed=arg.seed,
+                                  chunk_size=arg.chunk_size)
+        print(filename, '->', meta_file)
@@ -11,6 +11,14 @@ Usage Notes:
 
     Source min_range: 1.0
     Source max_range: 5.0
+
+    New recording days are added with --append: only the dates after the ones
+    already in dataset-file are processed and appended to the resizable
+    X_data/y_data, class_day_index ([class, day, start, count] rows) and the
+    class list are updated.
+
+    src-path is listed once into a manifest (--manifest, default next to
+    dataset-file), later runs only rescan directories whose mtime changed.
 '''
 
 from joblib import Parallel, delayed
@@ -25,6 +33,7 @@ import argparse
 import cv2
 import h5py
 import itertools, operator
+import json
 import math
 import matplotlib.pyplot as plt
 import numpy as np
@@ -91,26 +100,83 @@ def readDCA1000_1642(fileName):
     return adcData
 
 
+# walk the raw data tree once with os.scandir, {relative dir: {'mtime',
+# 'dirs', 'files': {name: [size, mtime]}}}. Entries of the previous manifest
+# are reused for directories whose mtime did not change (files added, removed
+# or renamed change it), so a rescan costs one stat per directory
+def index_tree(dataset_path, manifest_file=None):
+    cached = {}
+    if manifest_file is not None and os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            cached = json.load(f)
+    manifest = {}
+    pending = ['']
+    while pending:
+        rel = pending.pop()
+        path = os.path.join(dataset_path, rel)
+        mtime = os.stat(path).st_mtime_ns
+        entry = cached.get(rel)
+        if entry is None or entry['mtime'] != mtime:
+            entry = {'mtime': mtime, 'dirs': [], 'files': {}}
+            with os.scandir(path) as it:
+                for e in it:
+                    if e.name.startswith('.'):
+                        continue
+                    if e.is_dir():
+                        entry['dirs'].append(e.name)
+                    elif e.is_file():
+                        stat = e.stat()
+                        entry['files'][e.name] = [stat.st_size, stat.st_mtime_ns]
+            entry['dirs'].sort()
+        manifest[rel] = entry
+        pending.extend(os.path.join(rel, d) for d in entry['dirs'])
+    if manifest_file is not None:
+        tmp_file = '{}.tmp{}'.format(manifest_file, os.getpid())
+        with open(tmp_file, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_file, manifest_file)
+    return manifest
+
+
 # read bin files form mmwave studio and convert to numpy data
+# skip_days ({class: days}) skips the dates already in the dataset (append),
+# then up to num_days new dates are read per class. With a manifest
+# (index_tree) the tree is not listed again and sizes holds the recorded file
+# sizes (None without a manifest), get_spectrogram rejects the wrong sizes
+# without opening the file
 def read_samples(dataset_path,
                  classes=None,
                  num_samples=50,
                  num_days=5,
-                 endswith=".bin"):
+                 endswith=".bin",
+                 skip_days=None,
+                 manifest=None):
+    def listdir(rel):
+        if manifest is None:
+            return os.listdir(os.path.join(dataset_path, rel))
+        return manifest[rel]['dirs'] + list(manifest[rel]['files'])
+
+    def size(rel, sample):
+        return None if manifest is None else manifest[rel]['files'][sample][0]
+
     if classes is None:
-        classes = sorted([
-            f for f in os.listdir(dataset_path)
-            if os.path.isdir(os.path.join(dataset_path, f))
-            and not f.startswith('.')
-        ])
-    datapaths, labels = list(), list()
+        if manifest is not None:
+            classes = list(manifest['']['dirs'])
+        else:
+            classes = sorted([
+                f for f in os.listdir(dataset_path)
+                if os.path.isdir(os.path.join(dataset_path, f))
+                and not f.startswith('.')
+            ])
+    datapaths, labels, sizes = list(), list(), list()
     for c in classes:
         c_dir = os.path.join(dataset_path, c)
-        dates = sorted(os.listdir(c_dir))[:num_days]
-        if (len(dates)) < num_days:
+        start = 0 if skip_days is None else skip_days.get(c, 0)
+        dates = sorted(listdir(c))[start:start + num_days]
+        if (len(dates)) < num_days and skip_days is None:
             raise NameError("Not enough days for subject: {}".format(c))
         for date in dates:
-            samples = sorted(os.listdir(os.path.join(c_dir, date)))
+            samples = sorted(listdir(os.path.join(c, date)))
             samples = [
                 sample for sample in samples if sample.endswith(endswith)
             ]
@@ -119,8 +185,9 @@ def read_samples(dataset_path,
                 raise NameError("Not enough samples for subject: {}".format(c))
             for sample in samples:
                 datapaths.append(os.path.join(c_dir, date, sample))
-                labels.append([classes.index(c), dates.index(date)])
-    return datapaths, labels, classes
+                labels.append([classes.index(c), start + dates.index(date)])
+                sizes.append(size(os.path.join(c, date), sample))
+    return datapaths, labels, classes, sizes
 
 
 def fspecial_gaussian(size=15, sigma=2):
@@ -157,14 +224,25 @@ def get_range_mask(range_map):
 
 
 # generate spectrogram from TI mmwave data
-def get_spectrogram(fname, label, mat_file=False):
+# per recording metadata next to the spectrogram, direction 1 and -1 bins
+# mean the recording was rejected before they were known
+def get_spectrogram(fname, label, mat_file=False, size=None):
+    meta = {'direction': 1, 'range_start': -1, 'segment_start': -1,
+            'segment_end': -1, 'reject': 0}
+
+    def reject(reason):
+        meta['reject'] = REJECT_REASONS.index(reason)
+        return np.array([]), label, meta
+
     if mat_file:
         iq_data = loadmat(fname)["ans"]
     else:
-        if (os.path.getsize(fname) == 188416000):
+        if size is None:
+            size = os.path.getsize(fname)
+        if size == RECORDING_SIZE:
             iq_data = readDCA1000_1642(fname)
         else:
-            return np.array([]), label
+            return reject('file size')
 
     data = iq_data[0, :].reshape((-1, num_frame), order="F")
 
@@ -194,6 +272,7 @@ def get_spectrogram(fname, label, mat_file=False):
     while not (np.where(range_mask[start] > 0)[0].shape[0] > 0):
         start += 1
     range_matrix = range_matrix[start:]
+    meta['range_start'] = start
 
     range_matrix_tmp = np.abs(range_matrix)
     range_matrix_tmp = (20 *
@@ -201,17 +280,18 @@ def get_spectrogram(fname, label, mat_file=False):
     range_mask = get_range_mask(range_matrix_tmp)
 
     if (range_matrix.shape[0] < 1):
-        return np.array([]), label
+        return reject('empty range')
 
     if (np.where(range_mask[0] > 0)[0].shape[0] > 0):
         direc = -1 * (np.where(range_mask[0] > 0)[0][0] <
                       range_mask.shape[1] / 2)
+        meta['direction'] = direc
     else:
-        return np.array([]), label
+        return reject('no direction')
 
     for j in range(range_matrix.shape[0]):
         if not (len(np.where(range_mask[j] > 0)[0]) > 0):
-            return np.array([]), label
+            return reject('target lost')
 
         if direc:
             range_matrix[j, :np.where(range_mask[j] > 0)[0][direc] -
@@ -224,7 +304,7 @@ def get_spectrogram(fname, label, mat_file=False):
                          5 * attention_window_length:] = 0
 
     if (range_matrix.shape[0] < 1):
-        return np.array([]), label
+        return reject('empty range')
 
     for j in range(range_matrix.shape[0]):
         f_vec, t, S = signal.spectrogram(range_matrix[j, :],
@@ -266,6 +346,7 @@ def get_spectrogram(fname, label, mat_file=False):
          if x == 1),
         key=len)
     S_new_all = S_new_all[:, r[0][0]:r[-1][0]]
+    meta['segment_start'], meta['segment_end'] = r[0][0], r[-1][0]
 
     if direc == 0:
         S_new_all = S_new_all[128:int(S_new_all.shape[0] / 2),
@@ -279,9 +360,9 @@ def get_spectrogram(fname, label, mat_file=False):
         S_new_all = np.flip(S_new_all, axis=1)
 
     if (S_new_all.shape != (128, 1024)):
-        return np.array([]), label
+        return reject('shape')
 
-    return S_new_all, label
+    return S_new_all, label, meta
 
 
 def get_parser():
@@ -309,9 +390,190 @@ def get_parser():
                         type=float,
                         default=5.0,
                         help='maximum range to consider for computation')
+    parser.add_argument('--storage',
+                        default='float32',
+                        choices=['float32', 'float16', 'uint16', 'uint8'],
+                        help='dtype of X_data, integer types store scale and offset attributes')
+    parser.add_argument('--append',
+                        action='store_true',
+                        help='only process the dates newer than the ones in dataset-file and append them')
+    parser.add_argument('--manifest',
+                        default=None,
+                        help='cached index of src-path (default: dataset-file + .manifest.json)')
     return parser
 
 
+def quantize(X_data, dtype, attrs=None):
+    # X_data = q * scale + offset, read back by utils.get_h5dataset
+    # appended data reuses the stored scale/offset and is clipped to its range
+    dtype = np.dtype(dtype)
+    if dtype.kind == 'f':
+        return X_data.astype(dtype), {}
+    if not attrs:
+        offset = float(np.min(X_data))
+        scale = float(np.ptp(X_data)) / np.iinfo(dtype).max or 1.
+        attrs = {'scale': scale, 'offset': offset}
+    q = np.clip(np.rint((X_data - attrs['offset']) / attrs['scale']), 0, np.iinfo(dtype).max)
+    return q.astype(dtype), attrs
+
+
+# spectrograms of the recordings (cpu parallelised) resized to 256x256,
+# recordings that fail are dropped. meta has one row per recording, also
+# for the dropped ones, row is the sample index in X_data (-1 if dropped)
+def build_samples(files, labels, start=0, sizes=None):
+    if sizes is None:
+        sizes = [None] * len(files)
+    dset_X, dset_y, metas = zip(*Parallel(n_jobs=-1)(
+        delayed(get_spectrogram)(files[i], labels[i], size=sizes[i])
+        for i in tqdm(range(len(files)))))
+
+    dset_y = np.array(dset_y)
+    print(dset_y.shape, len(dset_X))
+
+    delete_inds = []
+    for ind in range(len(dset_X)):
+        if (dset_X[ind].shape != (128, 1024)):
+            delete_inds.append(ind)
+            print(files[ind])
+
+    print(len(delete_inds))
+
+    # dropped before stacking, numpy no longer builds ragged arrays
+    dset_X = np.array([x for ind, x in enumerate(dset_X) if ind not in delete_inds])
+    dset_y = np.delete(dset_y, delete_inds, 0)
+    print(dset_y.shape, dset_X.shape)
+
+    meta = {name: np.array([m[name] for m in metas], dtype=dtype)
+            for name, dtype in META_COLUMNS if name in metas[0]}
+    meta['path'] = np.array(files, dtype=object)
+    meta['class'] = np.array(labels, dtype=np.int16).reshape(-1, 2)[:, 0]
+    meta['day'] = np.array(labels, dtype=np.int16).reshape(-1, 2)[:, 1]
+    kept = np.ones(len(files), dtype=bool)
+    kept[delete_inds] = False
+    meta['row'] = np.where(kept, start + np.cumsum(kept) - 1, -1)
+
+    # resize spectrograms
+    data_resized = np.zeros((dset_X.shape[0], 256, 256, 1), dtype=np.float32)
+    for i in range(dset_X.shape[0]):
+        data_resized[i] = np.expand_dims(resize(dset_X[i], (256, 256)),
+                                         axis=-1)
+    dset_X = data_resized
+    print(dset_y.shape, dset_X.shape)
+    return dset_X, dset_y, meta
+
+
+# (class, day, start, count) rows: the samples of a class and day are the
+# contiguous X_data[start:start + count], every processed (class, day) gets a
+# row, also when all its recordings were dropped
+def class_day_index(labels, dset_y, start):
+    index = []
+    for c, day in sorted(set(map(tuple, labels))):
+        before = (dset_y[:, 0] < c) | ((dset_y[:, 0] == c) & (dset_y[:, 1] < day))
+        count = (dset_y[:, 0] == c) & (dset_y[:, 1] == day)
+        index.append([c, day, start + before.sum(), count.sum()])
+    return np.array(index, dtype=np.int64).reshape(-1, 4)
+
+
+# columnar per recording metadata under meta/, read by utils.query_recordings
+META_COLUMNS = [('path', h5py.string_dtype()), ('class', np.int16), ('day', np.int16),
+                ('direction', np.int8), ('range_start', np.int16),
+                ('segment_start', np.int32), ('segment_end', np.int32),
+                ('reject', np.uint8), ('row', np.int64)]
+
+
+def write_meta(hf, meta):
+    if 'meta' not in hf:
+        group = hf.create_group('meta')
+        group.attrs['reject_reasons'] = REJECT_REASONS
+        for name, dtype in META_COLUMNS:
+            group.create_dataset(name, shape=(0, ), dtype=dtype, maxshape=(None, ),
+                                 chunks=(4096, ))
+    for name, _ in META_COLUMNS:
+        append_rows(hf['meta'], name, meta[name])
+
+
+def write_dataset(filename, dset_X, dset_y, classes, index, storage, meta):
+    dset_X, attrs = quantize(dset_X, storage)
+    hf = h5py.File(filename, 'w')
+    # chunked and resizable so --append can extend them in place
+    hf.create_dataset('X_data', data=dset_X, maxshape=(None, ) + dset_X.shape[1:],
+                      chunks=(1, ) + dset_X.shape[1:])
+    hf['X_data'].attrs.update(attrs)
+    hf.create_dataset('y_data', data=dset_y, maxshape=(None, dset_y.shape[1]),
+                      chunks=(1024, dset_y.shape[1]))
+    hf.create_dataset('classes', data=classes)
+    hf.create_dataset('class_day_index', data=index, maxshape=(None, 4), chunks=(256, 4))
+    write_meta(hf, meta)
+    hf.close()
+
+
+# resizable datasets written by an older writer are rewritten once
+def make_resizable(hf, name, chunk_rows):
+    if hf[name].maxshape[0] is None:
+        return
+    print('rewriting {} as resizable dataset'.format(name))
+    data, attrs = hf[name][()], dict(hf[name].attrs)
+    del hf[name]
+    hf.create_dataset(name, data=data, maxshape=(None, ) + data.shape[1:],
+                      chunks=(chunk_rows, ) + data.shape[1:])
+    hf[name].attrs.update(attrs)
+
+
+def append_rows(hf, name, rows):
+    start = hf[name].shape[0]
+    hf[name].resize(start + rows.shape[0], axis=0)
+    hf[name][start:] = rows
+
+
+def append_dataset(filename, classes, arg, manifest):
+    # keep the stored class order, new classes go to the end
+    hf = h5py.File(filename, 'a')
+    stored = [n.decode("ascii", "ignore") for n in hf['classes']]
+    classes = stored + [c for c in classes if c not in stored]
+    files, labels, classes, sizes = read_samples(arg.src_path,
+                                                 classes=classes,
+                                                 num_samples=arg.num_samples,
+                                                 num_days=arg.num_days,
+                                                 endswith=".bin",
+                                                 skip_days=stored_days(hf, stored),
+                                                 manifest=manifest)
+    if len(files) == 0:
+        print('no new days')
+        hf.close()
+        return
+    dset_X, dset_y, meta = build_samples(files, labels, start=hf['X_data'].shape[0],
+                                         sizes=sizes)
+
+    make_resizable(hf, 'X_data', 1)
+    make_resizable(hf, 'y_data', 1024)
+    if 'class_day_index' not in hf:
+        # files written before the index: one row per stored (class, day)
+        y_stored = hf['y_data'][()]
+        hf.create_dataset('class_day_index', data=class_day_index(y_stored[:, :2], y_stored, 0),
+                          maxshape=(None, 4), chunks=(256, 4))
+    start = hf['X_data'].shape[0]
+    dset_X, _ = quantize(dset_X, hf['X_data'].dtype, dict(hf['X_data'].attrs))
+    append_rows(hf, 'X_data', dset_X)
+    append_rows(hf, 'y_data', dset_y.astype(hf['y_data'].dtype))
+    append_rows(hf, 'class_day_index', class_day_index(labels, dset_y, start))
+    # files from before the metadata only get rows for the appended recordings
+    write_meta(hf, meta)
+    if len(classes) > len(stored):
+        del hf['classes']
+        hf.create_dataset('classes', data=[n.encode("ascii", "ignore") for n in classes])
+    hf.close()
+
+
+def stored_days(hf, classes):
+    # days already in the file per class name
+    if 'class_day_index' in hf:
+        labels = hf['class_day_index'][:, :2]
+    else:
+        labels = hf['y_data'][()]
+    return {c: int(labels[labels[:, 0] == i, 1].max(initial=-1)) + 1
+            for i, c in enumerate(classes)}
+
+
 #-------------------------------------------------------------------#
 #parameters
 
@@ -331,6 +593,12 @@ noverlap = nfft - 16
 spec_window = signal.windows.chebwin(nfft, 120)
 attention_window_length = int(np.ceil(0.2 / chirp_duration))
 
+# size of one DCA1000 recording, other sizes are rejected ('file size')
+RECORDING_SIZE = 188416000
+
+# index = meta/reject code, 0 is a kept recording
+REJECT_REASONS = ['', 'file size', 'empty range', 'no direction', 'target lost', 'shape']
+
 classes = [
     'subject1', 'subject2', 'subject3', 'subject4', 'subject5', 'subject6',
     'subject7', 'subject8', 'subject9', 'subject10'
@@ -346,47 +614,19 @@ if __name__ == "__main__":
     range_min = int(np.ceil(min_range / range_res))
     range_max = int(np.ceil(max_range / range_res))
 
-    # get files and generate labels on disk
-    files, labels, classes = read_samples(arg.src_path,
-                                          classes=classes,
-                                          num_samples=arg.num_samples,
-                                          num_days=arg.num_days,
-                                          endswith=".bin")
-    classes = [n.encode("ascii", "ignore") for n in classes]
-
-    # generate spectrograms for entire dataset (cpu parallelised)
-    dset_X, dset_y = zip(*Parallel(n_jobs=-1)(
-        delayed(get_spectrogram)(files[i], labels[i])
-        for i in tqdm(range(len(files)))))
-
-    dset_X = np.array(dset_X)
-    dset_y = np.array(dset_y)
-    print(dset_y.shape, dset_X.shape)
-
-    delete_inds = []
-    for ind in range(len(dset_X)):
-        if (dset_X[ind].shape != (128, 1024)):
-            delete_inds.append(ind)
-            print(files[ind])
-
-    print(len(delete_inds))
-
-    dset_X = np.delete(dset_X, delete_inds, 0)
-    dset_X = np.array(list(dset_X))
-    dset_y = np.delete(dset_y, delete_inds, 0)
-    dset_y = np.array(list(dset_y))
-    print(dset_y.shape, dset_X.shape)
-
-    # resize spectrograms
-    data_resized = np.zeros((dset_X.shape[0], 256, 256, 1), dtype=np.float32)
-    for i in range(dset_X.shape[0]):
-        data_resized[i] = np.expand_dims(resize(dset_X[i], (256, 256)),
-                                         axis=-1)
-    dset_X = data_resized
-    print(dset_y.shape, dset_X.shape)
-
-    hf = h5py.File(arg.dataset_file, 'w')
-    hf.create_dataset('X_data', data=dset_X)
-    hf.create_dataset('y_data', data=dset_y)
-    hf.create_dataset('classes', data=classes)
-    hf.close()
+    manifest = index_tree(arg.src_path,
+                          arg.manifest or arg.dataset_file + '.manifest.json')
+    if arg.append:
+        append_dataset(arg.dataset_file, classes, arg, manifest)
+    else:
+        # get files and generate labels on disk
+        files, labels, classes, sizes = read_samples(arg.src_path,
+                                                     classes=classes,
+                                                     num_samples=arg.num_samples,
+                                                     num_days=arg.num_days,
+                                                     endswith=".bin",
+                                                     manifest=manifest)
+        dset_X, dset_y, meta = build_samples(files, labels, sizes=sizes)
+        index = class_day_index(labels, dset_y, 0)
+        classes = [n.encode("ascii", "ignore") for n in classes]
+        write_dataset(arg.dataset_file, dset_X, dset_y, classes, index, arg.storage, meta)
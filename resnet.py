@@ -1,4 +1,5 @@
 import tensorflow as tf
+from resnet_amca import DomainBatchNormalization
 
 L2_WEIGHT_DECAY = 1e-4
 BATCH_NORM_DECAY = 0.9
@@ -47,7 +48,7 @@ class IdentityBlock(tf.keras.Model):
             self.bn2a = tf.keras.layers.Dropout(rate=dropout_rate,
                                                 name=bn_name_base + '2a')
         elif regularizer.lower() == 'batchnorm':
-            self.bn2a = tf.keras.layers.BatchNormalization(
+            self.bn2a = DomainBatchNormalization(
                 axis=bn_axis,
                 momentum=BATCH_NORM_DECAY,
                 epsilon=BATCH_NORM_EPSILON,
@@ -66,7 +67,7 @@ class IdentityBlock(tf.keras.Model):
             self.bn2b = tf.keras.layers.Dropout(rate=dropout_rate,
                                                 name=bn_name_base + '2b')
         elif regularizer.lower() == 'batchnorm':
-            self.bn2b = tf.keras.layers.BatchNormalization(
+            self.bn2b = DomainBatchNormalization(
                 axis=bn_axis,
                 momentum=BATCH_NORM_DECAY,
                 epsilon=BATCH_NORM_EPSILON,
@@ -137,7 +138,7 @@ class ConvBlock(tf.keras.Model):
             self.bn2a = tf.keras.layers.Dropout(rate=dropout_rate,
                                                 name=bn_name_base + '2a')
         elif regularizer.lower() == 'batchnorm':
-            self.bn2a = tf.keras.layers.BatchNormalization(
+            self.bn2a = DomainBatchNormalization(
                 axis=bn_axis,
                 momentum=BATCH_NORM_DECAY,
                 epsilon=BATCH_NORM_EPSILON,
@@ -157,7 +158,7 @@ class ConvBlock(tf.keras.Model):
             self.bn2b = tf.keras.layers.Dropout(rate=dropout_rate,
                                                 name=bn_name_base + '2b')
         elif regularizer.lower() == 'batchnorm':
-            self.bn2b = tf.keras.layers.BatchNormalization(
+            self.bn2b = DomainBatchNormalization(
                 axis=bn_axis,
                 momentum=BATCH_NORM_DECAY,
                 epsilon=BATCH_NORM_EPSILON,
@@ -177,7 +178,7 @@ class ConvBlock(tf.keras.Model):
             self.bn2s = tf.keras.layers.Dropout(rate=dropout_rate,
                                                 name=bn_name_base + '2s')
         elif regularizer.lower() == 'batchnorm':
-            self.bn2s = tf.keras.layers.BatchNormalization(
+            self.bn2s = DomainBatchNormalization(
                 axis=bn_axis,
                 momentum=BATCH_NORM_DECAY,
                 epsilon=BATCH_NORM_EPSILON,
@@ -234,7 +235,7 @@ class ResNet50(tf.keras.Model):
             self.bn1 = tf.keras.layers.Dropout(rate=dropout_rate,
                                                name='bn_conv1')
         elif regularizer.lower() == 'batchnorm':
-            self.bn1 = tf.keras.layers.BatchNormalization(
+            self.bn1 = DomainBatchNormalization(
                 axis=bn_axis,
                 momentum=BATCH_NORM_DECAY,
                 epsilon=BATCH_NORM_EPSILON,
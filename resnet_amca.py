@@ -1,3 +1,4 @@
+import contextlib
 import tensorflow as tf
 
 L2_WEIGHT_DECAY = 1e-4
@@ -55,6 +56,85 @@ class AMDense(tf.keras.layers.Layer):
                          tf.nn.l2_normalize(self.kernel, 0))
 
 
+"""
+BatchNormalization that can normalize a batch of concatenated, equally sized
+views (e.g. source, weak target and strong target) with per view statistics,
+so one fused forward pass keeps the statistics of separate passes. The
+number of views is set on the layer (see batch_norm_views), with 1 or
+outside training it is a plain BatchNormalization. The moving statistics are
+updated once with the mean of the per view moments.
+"""
+
+
+class DomainBatchNormalization(tf.keras.layers.BatchNormalization):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.num_views = 1
+
+    def call(self, inputs, training=None):
+        if not training or self.num_views == 1:
+            return super().call(inputs, training=training)
+        shape = tf.shape(inputs)
+        views = tf.reshape(inputs, tf.concat([[self.num_views, -1], shape[1:]], 0))
+        axes = list(range(1, len(inputs.shape)))
+        mean, variance = tf.nn.moments(views, axes, keepdims=True)
+        outputs = tf.nn.batch_normalization(views, mean, variance, self.beta,
+                                            self.gamma, self.epsilon)
+        momentum = tf.cast(self.momentum, inputs.dtype)
+        self.moving_mean.assign(self.moving_mean * momentum +
+                                tf.reshape(tf.reduce_mean(mean, 0), [-1]) * (1 - momentum))
+        self.moving_variance.assign(self.moving_variance * momentum +
+                                    tf.reshape(tf.reduce_mean(variance, 0), [-1]) * (1 - momentum))
+        return tf.reshape(outputs, shape)
+
+
+"""Normalize the next model calls with per view batch statistics, the
+DomainBatchNormalization layers of model split their training batch into
+num_views equal parts. Set at trace time, use it inside the train step.
+"""
+
+
+@contextlib.contextmanager
+def batch_norm_views(model, num_views):
+    layers = [layer for layer in model.submodules
+              if isinstance(layer, DomainBatchNormalization)]
+    for layer in layers:
+        layer.num_views = num_views
+    try:
+        yield
+    finally:
+        for layer in layers:
+            layer.num_views = 1
+
+
+"""One forward pass over several views (e.g. source, weak and strong target)
+concatenated into one batch, the output(s) are split back per view.
+bn_mode 'shared' normalizes the fused batch with one set of batch
+statistics, 'domain' with per view statistics like separate calls (views
+then need the same batch size).
+Args:
+  model: keras model
+  views: list of 4D tensors
+  bn_mode: 'shared' or 'domain'
+  kwargs: passed to the model call
+
+Returns:
+  A list with the model output per view, or per model output a list per view
+  if the model returns a tuple.
+"""
+BN_MODES = ('shared', 'domain')
+
+
+def fused_call(model, views, bn_mode='shared', **kwargs):
+    sizes = tf.stack([tf.shape(view)[0] for view in views])
+    num_views = len(views) if bn_mode == 'domain' else 1
+    with batch_norm_views(model, num_views):
+        outputs = model(tf.concat(views, 0), **kwargs)
+    if isinstance(outputs, (tuple, list)):
+        return [tf.split(output, sizes, num=len(views)) for output in outputs]
+    return tf.split(outputs, sizes, num=len(views))
+
+
 """A block that has a identity layer at shortcut.
 Args:
   kernel_size: the kernel size of middle conv layer at main path
@@ -99,7 +179,7 @@ class IdentityBlock(tf.keras.Model):
             self.bn2a = tf.keras.layers.Dropout(rate=dropout_rate,
                                                 name=bn_name_base + '2a')
         elif regularizer.lower() == 'batchnorm':
-            self.bn2a = tf.keras.layers.BatchNormalization(
+            self.bn2a = DomainBatchNormalization(
                 axis=bn_axis,
                 momentum=BATCH_NORM_DECAY,
                 epsilon=BATCH_NORM_EPSILON,
@@ -118,7 +198,7 @@ class IdentityBlock(tf.keras.Model):
             self.bn2b = tf.keras.layers.Dropout(rate=dropout_rate,
                                                 name=bn_name_base + '2b')
         elif regularizer.lower() == 'batchnorm':
-            self.bn2b = tf.keras.layers.BatchNormalization(
+            self.bn2b = DomainBatchNormalization(
                 axis=bn_axis,
                 momentum=BATCH_NORM_DECAY,
                 epsilon=BATCH_NORM_EPSILON,
@@ -189,7 +269,7 @@ class ConvBlock(tf.keras.Model):
             self.bn2a = tf.keras.layers.Dropout(rate=dropout_rate,
                                                 name=bn_name_base + '2a')
         elif regularizer.lower() == 'batchnorm':
-            self.bn2a = tf.keras.layers.BatchNormalization(
+            self.bn2a = DomainBatchNormalization(
                 axis=bn_axis,
                 momentum=BATCH_NORM_DECAY,
                 epsilon=BATCH_NORM_EPSILON,
@@ -209,7 +289,7 @@ class ConvBlock(tf.keras.Model):
             self.bn2b = tf.keras.layers.Dropout(rate=dropout_rate,
                                                 name=bn_name_base + '2b')
         elif regularizer.lower() == 'batchnorm':
-            self.bn2b = tf.keras.layers.BatchNormalization(
+            self.bn2b = DomainBatchNormalization(
                 axis=bn_axis,
                 momentum=BATCH_NORM_DECAY,
                 epsilon=BATCH_NORM_EPSILON,
@@ -229,7 +309,7 @@ class ConvBlock(tf.keras.Model):
             self.bn2s = tf.keras.layers.Dropout(rate=dropout_rate,
                                                 name=bn_name_base + '2s')
         elif regularizer.lower() == 'batchnorm':
-            self.bn2s = tf.keras.layers.BatchNormalization(
+            self.bn2s = DomainBatchNormalization(
                 axis=bn_axis,
                 momentum=BATCH_NORM_DECAY,
                 epsilon=BATCH_NORM_EPSILON,
@@ -287,7 +367,7 @@ class ResNetAMCA(tf.keras.Model):
             self.bn1 = tf.keras.layers.Dropout(rate=dropout_rate,
                                                name='bn_conv1')
         elif regularizer.lower() == 'batchnorm':
-            self.bn1 = tf.keras.layers.BatchNormalization(
+            self.bn1 = DomainBatchNormalization(
                 axis=bn_axis,
                 momentum=BATCH_NORM_DECAY,
                 epsilon=BATCH_NORM_EPSILON,
@@ -1,7 +1,11 @@
 import os
 import io
+import json
 import h5py
+import shutil
+import hashlib
 import itertools
+import collections
 import numpy as np
 import matplotlib
 matplotlib.use('Agg')
@@ -10,6 +14,13 @@ import matplotlib.pyplot as plt
 from sklearn.model_selection import train_test_split
 import random
 import argparse
+import threading
+import time
+import atexit
+import multiprocessing
+from multiprocessing import shared_memory
+from multiprocessing.connection import wait
+from concurrent.futures import ThreadPoolExecutor
 
 def load(path, **kwargs):
     ckpt = tf.train.Checkpoint(**kwargs)
@@ -20,6 +31,62 @@ def load(path, **kwargs):
     return ckpt_manager
 
 
+'''
+Periodic resume checkpoints of a training stage, by epoch count and/or wall
+time. Saves the tracked objects (model, optimizer, ...) with the last finished
+epoch, pass the augmentation seed generators of the training datasets
+(seed_generators) so a resumed run continues their seed stream. Writes run
+asynchronously (the values are copied and written by a background thread), so
+training does not wait on disk. tf.data iterator state is not saved, a resumed
+run starts the next epoch with freshly shuffled datasets, and the seeds of the
+batches that were already prefetched when the checkpoint was written are
+skipped.
+args:
+    directory: string, checkpoint directory of the stage
+    every_epochs: int, save every n epochs (0: off)
+    every_minutes: float, save when n minutes passed since the last save (0: off)
+    objects: trackable objects to save, e.g. model=model, optimizer=optimizer
+'''
+class PeriodicCheckpoint:
+    def __init__(self, directory, every_epochs=0, every_minutes=0, max_to_keep=2,
+                 **objects):
+        self.epoch = tf.Variable(-1, dtype=tf.int64, trainable=False)
+        self.ckpt = tf.train.Checkpoint(epoch=self.epoch, **objects)
+        self.manager = tf.train.CheckpointManager(self.ckpt, directory,
+                                                  max_to_keep=max_to_keep)
+        self.options = tf.train.CheckpointOptions(
+            experimental_enable_async_checkpoint=True)
+        self.every_epochs = every_epochs
+        self.every_seconds = every_minutes * 60
+        self.last_save = time.monotonic()
+
+    def restore(self, start=0):
+        # returns the epoch to continue from
+        if not self.manager.latest_checkpoint:
+            return start
+        self.ckpt.restore(self.manager.latest_checkpoint)
+        print('Resumed {} after epoch {}'.format(self.manager.latest_checkpoint,
+                                                 int(self.epoch.numpy())))
+        return max(start, int(self.epoch.numpy()) + 1)
+
+    def step(self, epoch, force=False):
+        # call after every finished epoch
+        if self.every_epochs <= 0 and self.every_seconds <= 0:
+            return
+        due = force or \
+            (self.every_epochs > 0 and (epoch + 1) % self.every_epochs == 0) or \
+            (self.every_seconds > 0 and time.monotonic() - self.last_save >= self.every_seconds)
+        if not due:
+            return
+        self.epoch.assign(epoch)
+        self.manager.save(checkpoint_number=epoch, options=self.options)
+        self.last_save = time.monotonic()
+
+    def wait(self):
+        # block until the pending write is on disk
+        self.ckpt.sync()
+
+
 def plot_to_image(figure):
     """Converts the matplotlib plot specified by 'figure' to a PNG image and
   returns it. The supplied figure is closed and inaccessible after this call."""
@@ -69,6 +136,55 @@ def plot_confusion_matrix(cm, class_names):
     return figure
 
 
+'''
+Writes a confusion matrix figure to the default summary writer
+args:
+    name: string, summary name
+    cm: 2D numpy array, confusion matrix (e.g. EvalResult.confusion)
+    class_names: list, names of the classes
+    step: int, summary step
+'''
+
+
+def log_confusion_matrix(name, cm, class_names, step):
+    cm_image = plot_to_image(plot_confusion_matrix(cm, class_names=class_names))
+    tf.summary.image(name, cm_image, step=step)
+
+
+'''
+Returns evaluate(data_set) -> EvalResult, one pass over a labeled test set
+inside a tf.function. The predictions stay on device, only the confusion
+matrix (accumulated with tf.math.confusion_matrix) is copied back.
+args:
+    predict_fn: function(x_batch) -> class scores, e.g. test_step
+    num_classes: int, number of classes
+output:
+    evaluate: function, EvalResult(accuracy, confusion, class_counts,
+              class_accuracy) with numpy values, rows of confusion are the
+              true labels
+'''
+EvalResult = collections.namedtuple(
+    'EvalResult', ['accuracy', 'confusion', 'class_counts', 'class_accuracy'])
+
+
+def test_evaluator(predict_fn, num_classes):
+    @tf.function
+    def confusion(data_set):
+        cm = tf.zeros((num_classes, num_classes), tf.int32)
+        for x, y in data_set:
+            pred = tf.argmax(predict_fn(x), axis=-1, output_type=tf.int32)
+            cm += tf.math.confusion_matrix(tf.cast(y, tf.int32), pred,
+                                           num_classes, dtype=tf.int32)
+        return cm
+
+    def evaluate(data_set):
+        cm = confusion(data_set).numpy()
+        class_counts = cm.sum(axis=1)
+        return EvalResult(np.trace(cm) / max(cm.sum(), 1), cm, class_counts,
+                          np.diag(cm) / np.maximum(class_counts, 1))
+    return evaluate
+
+
 class anneal():
     def __init__(self, init_val, final_val, delta=5):
         self.init_val = tf.constant(init_val, dtype="float32")
@@ -83,76 +199,122 @@ class anneal():
 
 '''
 Center Loss
+The centers are updated in place by get_center_loss (scatter_nd_sub), so it can
+be called from any train_step, eager or tf.function. labels may be sparse or
+one-hot. Inter-center distances use |a|^2 + |b|^2 - 2ab^T, O(C*D) memory.
 '''
 
 
-class CenterLoss():
-    def __init__(self, batch_size, num_classes, len_features, alpha):
+class CenterLoss(tf.Module):
+    def __init__(self, batch_size, num_classes, len_features, alpha, name=None):
+        super().__init__(name=name)
         self.centers = tf.Variable(tf.zeros([num_classes, len_features]),
                                    dtype=tf.float32,
                                    trainable=False)
-        self.alpha = alpha
+        self.alpha = tf.Variable(alpha, dtype=tf.float32, trainable=False)
         self.num_classes = num_classes
         self.batch_size = batch_size
         self.margin = tf.constant(100, dtype="float32")
-        self.norm = lambda x: tf.reduce_sum(tf.square(x), 1)
         self.EdgeWeights = tf.ones((self.num_classes, self.num_classes)) - \
             tf.eye(self.num_classes)
 
+    def pairwise_dist(self, centers):
+        sq_norm = tf.reduce_sum(tf.square(centers), 1)
+        dist = sq_norm[:, None] + sq_norm[None, :] - \
+            2 * tf.matmul(centers, centers, transpose_b=True)
+        return tf.maximum(dist, 0.0)
+
     def get_center_loss(self, features, labels, alpha=None):
         if alpha is not None:
-            self.alpha = alpha
+            self.alpha.assign(alpha)
 
-        labels = tf.reshape(tf.argmax(labels, axis=-1), [-1])
+        if labels.shape.rank == 2:
+            labels = tf.argmax(labels, axis=-1)
+        labels = tf.cast(tf.reshape(labels, [-1]), tf.int32)
         centers0 = tf.math.unsorted_segment_mean(features, labels,
                                                  self.num_classes)
-        center_pairwise_dist = tf.transpose(self.norm(tf.expand_dims(centers0, 2) -
-                                                      tf.transpose(centers0)))
-        self.inter_loss = tf.math.reduce_sum(
+        center_pairwise_dist = self.pairwise_dist(centers0)
+        inter_loss = tf.math.reduce_sum(
             tf.multiply(tf.maximum(0.0, self.margin - center_pairwise_dist),
                         self.EdgeWeights))
 
-        unique_label, unique_idx, unique_count = tf.unique_with_counts(labels)
-        appear_times = tf.gather(unique_count, unique_idx)
-        appear_times = tf.reshape(appear_times, [-1, 1])
+        appear_times = tf.math.bincount(labels, minlength=self.num_classes,
+                                        dtype=tf.float32)
+        appear_times = tf.gather(appear_times, labels)[:, None]
         centers_batch = tf.gather(self.centers, labels)
-        diff = centers_batch - features
-        diff /= tf.cast((1 + appear_times), tf.float32)
+        intra_loss = tf.nn.l2_loss(features - centers_batch)
+
+        diff = centers_batch - tf.stop_gradient(features)
+        diff /= 1 + appear_times
         diff *= self.alpha
-        self.centers_update_op = tf.compat.v1.scatter_sub(
-            self.centers, labels, diff)
+        self.centers.scatter_nd_sub(labels[:, None], diff)
+
+        center_loss = intra_loss + inter_loss
+        center_loss /= (self.num_classes * self.batch_size +
+                        self.num_classes * self.num_classes)
+        return center_loss
+
+
+'''
+Stateless helpers of mixup/cutmix: a draw from Beta(alpha, alpha) as the ratio
+of two gamma draws and a random permutation of the batch, both valid for an
+unknown batch size. Without a seed one is drawn from the global generator, so
+every call (also inside a tf.function) gets new randomness.
+'''
+
+
+def mix_seeds(seed, num):
+    if seed is None:
+        seed = tf.random.uniform([2], 0, 2**31 - 1, dtype=tf.int32)
+    return tf.random.experimental.stateless_split(seed, num)
+
+
+def random_beta(shape, seed, alpha):
+    seeds = tf.random.experimental.stateless_split(seed, 2)
+    gamma_a = tf.random.stateless_gamma(shape, seeds[0], alpha)
+    gamma_b = tf.random.stateless_gamma(shape, seeds[1], alpha)
+    return gamma_a / (gamma_a + gamma_b)
 
-        self.intra_loss = tf.nn.l2_loss(features - centers_batch)
-        self.center_loss = self.intra_loss + self.inter_loss
-        self.center_loss /= (self.num_classes * self.batch_size +
-                             self.num_classes * self.num_classes)
-        return self.center_loss
+
+def random_permutation(batch_size, seed):
+    return tf.argsort(tf.random.stateless_uniform([batch_size], seed))
+
+
+def mix_labels(y, num_classes):
+    if num_classes is not None and y.shape.rank == 1:
+        y = tf.one_hot(y, num_classes)
+    return tf.cast(y, tf.float32)
 
 
 '''
 MixUp: Regularization Strategy
 https://arxiv.org/abs/1710.09412
+Usable inside tf.function steps and as array_dataset map_fn (seed per batch)
 args:
-    x: 4D numpy array, with shape [batch_size, height, width, channels]
-    y: 2D numpy array, with shape [batch_size, dim_logits]
-    alpha: int, alpha parameter for beta distribution
+    x: 4D tensor, with shape [batch_size, height, width, channels]
+    y: 2D tensor, with shape [batch_size, dim_logits], or sparse labels with
+       num_classes
+    seed: None or int tensor [2], stateless random seed
+    alpha: float, alpha parameter for beta distribution
+    num_classes: None or int, one-hot sparse labels to num_classes
 output:
-    data: numpy arrays, cutmix features and labels
+    data: tensors, mixup features and labels
 '''
 
 
-def mixup(x, y, alpha=1):
+def mixup(x, y, seed=None, alpha=1, num_classes=None):
     x = tf.cast(x, tf.float32)
-    y = tf.cast(y, tf.float32)
+    y = mix_labels(y, num_classes)
+    seeds = mix_seeds(seed, 2)
 
     # random sample the lambda value from beta distribution.
-    batch_size = x.get_shape().as_list()[0]
-    weight = np.random.beta(alpha, alpha, batch_size)
-    x_weight = weight.reshape(batch_size, 1, 1, 1)
-    y_weight = weight.reshape(batch_size, 1)
+    batch_size = tf.shape(x)[0]
+    weight = random_beta([batch_size], seeds[0], alpha)
+    x_weight = tf.reshape(weight, [-1, 1, 1, 1])
+    y_weight = tf.reshape(weight, [-1, 1])
 
     # Perform the mixup.
-    indices = tf.random.shuffle(tf.range(batch_size))
+    indices = random_permutation(batch_size, seeds[1])
     features = (x * x_weight) + (tf.gather(x, indices) * (1 - x_weight))
     labels = (y * y_weight) + (tf.gather(y, indices) * (1 - y_weight))
 
@@ -162,48 +324,55 @@ def mixup(x, y, alpha=1):
 '''
 CutMix: Regularization Strategy to Train Strong Classifiers with Localizable
 Features https://arxiv.org/abs/1905.04899
+The masks of the whole batch are built at once, the labels are mixed by the
+area actually pasted (box clipped to the image). Usable inside tf.function
+steps and as array_dataset map_fn (seed per batch)
 args:
-    x: 4D numpy array, with shape [batch_size, height, width, channels]
-    y: 2D numpy array, with shape [batch_size, dim_logits]
-    alpha: int, alpha parameter for beta distribution
+    x: 4D tensor, with shape [batch_size, height, width, channels]
+    y: 2D tensor, with shape [batch_size, dim_logits], or sparse labels with
+       num_classes
+    seed: None or int tensor [2], stateless random seed
+    alpha: float, alpha parameter for beta distribution
+    per_sample: bool, draw lambda and box per sample instead of one per batch
+    num_classes: None or int, one-hot sparse labels to num_classes
 output:
-    data: numpy arrays, cutmix features and labels
+    data: tensors, cutmix features and labels
 '''
 
 
-def cutmix(x, y, alpha=1):
+def cutmix(x, y, seed=None, alpha=1, per_sample=False, num_classes=None):
     x = tf.cast(x, tf.float32)
-    y = tf.cast(y, tf.float32)
+    y = mix_labels(y, num_classes)
+    seeds = mix_seeds(seed, 3)
 
-    shape = x.get_shape()
+    shape = tf.shape(x)
     batch_size = shape[0]
-    image_h = shape[1]
-    image_w = shape[2]
-    channels = shape[3]
-
-    lam = np.random.beta(alpha, alpha)
-    cx = tf.random.uniform(shape=[],
-                           minval=0,
-                           maxval=image_w,
-                           dtype=tf.float32)
-    cy = tf.random.uniform(shape=[],
-                           minval=0,
-                           maxval=image_h,
-                           dtype=tf.float32)
+    image_h = tf.cast(shape[1], tf.float32)
+    image_w = tf.cast(shape[2], tf.float32)
+
+    num_draws = batch_size if per_sample else 1
+    lam = random_beta([num_draws], seeds[0], alpha)
+    u_x, u_y = tf.unstack(tf.random.stateless_uniform([2, num_draws], seeds[1]))
+    cx = u_x * image_w
+    cy = u_y * image_h
     w = image_w * tf.sqrt(1 - lam)
     h = image_h * tf.sqrt(1 - lam)
 
-    x0 = tf.cast(tf.round(tf.maximum(cx - w / 2, 0)), tf.int32)
-    x1 = tf.cast(tf.round(tf.minimum(cx + w / 2, image_w)), tf.int32)
-    y0 = tf.cast(tf.round(tf.maximum(cy - h / 2, 0)), tf.int32)
-    y1 = tf.cast(tf.round(tf.minimum(cy + h / 2, image_h)), tf.int32)
-
-    mask = tf.pad(
-        tf.ones([batch_size, y1 - y0, x1 - x0, channels], dtype=tf.bool),
-        [[0, 0], [y0, image_h - y1], [x0, image_w - x1], [0, 0]])
-    indices = tf.random.shuffle(tf.range(batch_size))
-    features = (x * tf.cast(tf.logical_not(mask), x.dtype)) + \
-        (tf.gather(x, indices) * tf.cast(mask, x.dtype))
+    x0 = tf.round(tf.maximum(cx - w / 2, 0))
+    x1 = tf.round(tf.minimum(cx + w / 2, image_w))
+    y0 = tf.round(tf.maximum(cy - h / 2, 0))
+    y1 = tf.round(tf.minimum(cy + h / 2, image_h))
+
+    rows = tf.range(image_h)[None, :]
+    cols = tf.range(image_w)[None, :]
+    in_rows = (rows >= y0[:, None]) & (rows < y1[:, None])
+    in_cols = (cols >= x0[:, None]) & (cols < x1[:, None])
+    mask = in_rows[:, :, None, None] & in_cols[:, None, :, None]
+    lam = 1 - (x1 - x0) * (y1 - y0) / (image_w * image_h)
+
+    indices = random_permutation(batch_size, seeds[2])
+    features = tf.where(mask, tf.gather(x, indices), x)
+    lam = tf.reshape(lam, [-1, 1])
     labels = (y * lam) + (tf.gather(y, indices) * (1 - lam))
 
     return tf.stop_gradient(features), tf.stop_gradient(labels)
@@ -215,13 +384,16 @@ args:
     filename: string, filename of h5py dataset
 output:
     data: tuple, with (X_data, y_data, classes)
-          where X_data and y_data are numpy arrays and classes is a list
+          where X_data and y_data are numpy arrays and classes is a list,
+          X_data stored quantized (float16, uint8, uint16) is returned float32
 '''
 
 
 def get_h5dataset(filename):
     hf = h5py.File(filename, 'r')
-    X_data = np.array(hf.get('X_data'))
+    X_data = hf.get('X_data')
+    X_data = dequantize(np.array(X_data), X_data.attrs.get('scale', 1.),
+                        X_data.attrs.get('offset', 0.))
     y_data = np.array(hf.get('y_data'))
     classes = list(hf.get('classes'))
     classes = [n.decode("ascii", "ignore") for n in classes]
@@ -229,6 +401,55 @@ def get_h5dataset(filename):
     return X_data, y_data, classes
 
 
+def get_h5classes(filename):
+    with h5py.File(filename, 'r') as hf:
+        classes = [n.decode("ascii", "ignore") for n in hf.get('classes')]
+    return classes
+
+
+'''
+Selects recordings by their preprocessing metadata (meta/ group written by
+preprocess/mmwave_spectrogram.py, one row per processed recording including
+the rejected ones) without reading X_data, e.g.
+    query_recordings(f, lambda m: m['direction'] == -1)
+    query_recordings(f, lambda m: m['segment_end'] - m['segment_start'] > 2000)
+args:
+    filename: string, filename of h5py dataset
+    where: None or function(meta) -> bool mask, meta is a dict of numpy
+           columns path, class, day, direction, range_start, segment_start,
+           segment_end, reject, reject_reason and row
+    kept: bool, only recordings that are in X_data
+output:
+    meta: dict of numpy columns of the selected recordings, meta['row'] are
+          their indices in X_data/y_data (get_h5rows)
+'''
+
+
+def query_recordings(filename, where=None, kept=True):
+    with h5py.File(filename, 'r') as hf:
+        group = hf['meta']
+        meta = {name: group[name][()] for name in group if name != 'path'}
+        meta['path'] = group['path'].asstr()[()]
+        reasons = np.array([str(r) for r in group.attrs['reject_reasons']])
+    meta['reject_reason'] = reasons[meta['reject']]
+    mask = np.ones(meta['row'].shape[0], dtype=bool)
+    if kept:
+        mask &= meta['row'] >= 0
+    if where is not None:
+        mask &= where(meta)
+    return {name: column[mask] for name, column in meta.items()}
+
+
+def get_h5rows(filename, rows):
+    rows = np.unique(rows)
+    with h5py.File(filename, 'r') as hf:
+        X_data = hf.get('X_data')
+        X_rows = dequantize(X_data[rows], X_data.attrs.get('scale', 1.),
+                            X_data.attrs.get('offset', 0.))
+        y_rows = hf.get('y_data')[rows]
+    return X_rows, y_rows
+
+
 '''
 Balances the dataset to have same number of samples in every class and every day
 args:
@@ -330,21 +551,100 @@ def normalize(X_data, data_min=None, data_ptp=None):
     return X_data, data_min, data_ptp
 
 
+'''
+Returns a lookup table from target class index to source class index, so the
+labels of a whole split are remapped with one fancy index
+args:
+    src_classes: list, class names from source domain
+    trg_classes: list, class names from target domain
+output:
+    label_map: numpy int32 array [len(trg_classes)]
+'''
+
+
+def class_lookup(src_classes, trg_classes):
+    return np.array([src_classes.index(name) for name in trg_classes],
+                    dtype=np.int32)
+
+
+'''
+Quantized storage of the prepared feature arrays. float16 is stored as is,
+uint8/uint16 store round((x - offset) / scale) with a per array scale and
+offset. Spectrograms are normalized to [-1, 1], so the rounding error is at
+most ptp/510 (uint8), ptp/131070 (uint16) or 2**-11 relative (float16).
+QuantizedArray is an ndarray subclass carrying scale/offset, slices and fancy
+indexing keep them. Data is dequantized to float32 per batch when it is used
+(dequantize in numpy, dequantize_batch inside tf.data).
+'''
+
+STORAGE_DTYPES = ('float32', 'float16', 'uint16', 'uint8')
+
+
+class QuantizedArray(np.ndarray):
+    def __new__(cls, data, scale, offset):
+        array = np.asarray(data).view(cls)
+        array.scale, array.offset = scale, offset
+        return array
+
+    def __array_finalize__(self, obj):
+        self.scale = getattr(obj, 'scale', 1.)
+        self.offset = getattr(obj, 'offset', 0.)
+
+
+def quantize(x_data, dtype):
+    dtype = np.dtype(dtype)
+    if dtype.kind == 'f':
+        return x_data.astype(dtype)
+    offset, scale = 0., 1.
+    if x_data.size > 0:
+        offset = float(np.min(x_data))
+        scale = float(np.ptp(x_data)) / np.iinfo(dtype).max or 1.
+    return QuantizedArray(np.rint((x_data - offset) / scale).astype(dtype), scale, offset)
+
+
+def quant_params(x_data):
+    return getattr(x_data, 'scale', 1.), getattr(x_data, 'offset', 0.)
+
+
+def dequantize(x_data, scale=None, offset=None):
+    if scale is None:
+        scale, offset = quant_params(x_data)
+    x = np.asarray(x_data)
+    if x.dtype.kind in 'ui':
+        return x.astype(np.float32) * np.float32(scale) + np.float32(offset)
+    return x.astype(np.float32, copy=False)
+
+
+def dequantize_batch(x, scale=1., offset=0.):
+    if x.dtype.is_integer:
+        return tf.cast(x, tf.float32) * scale + offset
+    return tf.cast(x, tf.float32)
+
+
 '''
 preprocess target domain data
 args:
     filename: string, filename of h5py dataset
     src_classes: list, class names from source domain
     train_trg_days: number of days to use as training data
+    storage: string, dtype the features are kept in (STORAGE_DTYPES)
 output:
     X_train_trg: processed training features
-    y_train_trg: processed training labels
+    y_train_trg: processed training labels, sparse int32
     X_test_trg: processed testing features
-    y_test_trg: processed testing labels
+    y_test_trg: processed testing labels, sparse int32
 '''
 
 
-def get_trg_data(filename, src_classes, train_trg_days, test_all=False, trgt_max=None):
+def get_trg_data(filename, src_classes, train_trg_days, test_all=False, trgt_max=None, shared=False,
+                 storage='float32'):
+    if shared:
+        key = shared_key('get_trg_data', filename, os.path.getmtime(filename),
+                         src_classes, train_trg_days, test_all, trgt_max, storage)
+        return shared_arrays(key, get_trg_data, filename, src_classes,
+                             train_trg_days, test_all=test_all, trgt_max=trgt_max,
+                             storage=storage)
+
     X_data_trg, y_data_trg, trg_classes = get_h5dataset(filename)
 
     # split days of data to train and test
@@ -353,40 +653,518 @@ def get_trg_data(filename, src_classes, train_trg_days, test_all=False, trgt_max
     if trgt_max is not None and len(y_train_trg) > 0:
         trgt_max = [int(i) for i in trgt_max]
         X_train_trg, y_train_trg = unbalance_dataset(X_train_trg, y_train_trg, trgt_max[0], trgt_max[1])
-    y_train_trg = y_train_trg[:, 0]
-    y_train_trg = np.array([
-        src_classes.index(trg_classes[y_train_trg[i]])
-        for i in range(y_train_trg.shape[0])
-    ])
+    label_map = class_lookup(src_classes, trg_classes)
+    y_train_trg = label_map[y_train_trg[:, 0]]
 
     test_days = 0 if test_all else 3
     X_test_trg = X_data_trg[y_data_trg[:, 1] >= test_days]
-    y_test_trg = y_data_trg[y_data_trg[:, 1] >= test_days, 0]
-    y_test_trg = np.array([
-        src_classes.index(trg_classes[y_test_trg[i]])
-        for i in range(y_test_trg.shape[0])
-    ])
+    y_test_trg = label_map[y_data_trg[y_data_trg[:, 1] >= test_days, 0]]
 
     if (X_train_trg.shape[0] != 0):
         X_train_trg, trg_mean = mean_center(X_train_trg)
         X_train_trg, trg_min, trg_ptp = normalize(X_train_trg)
-        y_train_trg = np.eye(len(src_classes))[y_train_trg]
 
         X_test_trg, _ = mean_center(X_test_trg, trg_mean)
         X_test_trg, _, _ = normalize(X_test_trg, trg_min, trg_ptp)
-        y_test_trg = np.eye(len(src_classes))[y_test_trg]
     else:
         X_test_trg, _ = mean_center(X_test_trg)
         X_test_trg, _, _ = normalize(X_test_trg)
-        y_test_trg = np.eye(len(src_classes))[y_test_trg]
 
-    X_train_trg = X_train_trg.astype(np.float32)
-    y_train_trg = y_train_trg.astype(np.uint8)
-    X_test_trg = X_test_trg.astype(np.float32)
-    y_test_trg = y_test_trg.astype(np.uint8)
+    X_train_trg = quantize(X_train_trg, storage)
+    y_train_trg = y_train_trg.astype(np.int32)
+    X_test_trg = quantize(X_test_trg, storage)
+    y_test_trg = y_test_trg.astype(np.int32)
 
     return X_train_trg, y_train_trg, X_test_trg, y_test_trg
 
+
+'''
+Registry of target domains that are only loaded (get_trg_data) when their
+train or test split is first used. Domains requested together with prefetch
+are loaded concurrently on a thread pool, the HDF5 reads and numpy
+normalization of one domain overlap with the others.
+args:
+    src_classes: list, class names from source domain
+    max_workers: int, number of domains loaded concurrently
+    kwargs: passed to get_trg_data for every domain (trgt_max, shared, ...)
+'''
+
+
+class TargetDomains:
+    def __init__(self, src_classes, max_workers=3, **kwargs):
+        self.src_classes, self.kwargs = src_classes, kwargs
+        self.domains, self.futures = {}, {}
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+
+    def register(self, name, filename, train_trg_days, **kwargs):
+        self.domains[name] = (filename, train_trg_days, dict(self.kwargs, **kwargs))
+
+    def trained(self):
+        return [name for name, (_, days, _) in self.domains.items() if days > 0]
+
+    def prefetch(self, *names):
+        with self.lock:
+            for name in names:
+                if name not in self.futures:
+                    filename, days, kwargs = self.domains[name]
+                    self.futures[name] = self.pool.submit(
+                        get_trg_data, filename, self.src_classes, days, **kwargs)
+
+    def load(self, name):
+        self.prefetch(name)
+        return self.futures[name].result()
+
+    def train(self, name):
+        return self.load(name)[:2]
+
+    def test(self, name):
+        return self.load(name)[2:]
+
+    def summary(self):
+        for name in self.futures:
+            X_train, y_train, X_test, y_test = self.load(name)
+            print(" Train {}:".format(name), X_train.shape, y_train.shape, "\n",
+                  "Test {}: ".format(name), X_test.shape, y_test.shape)
+
+
+'''
+preprocess source domain data, the days after the source days are split off
+as the temporal target domain
+args:
+    filename: string, filename of h5py dataset
+    train_src_days: number of days to use as source data
+    train_trg_days: number of days after the source days to use as temporal
+                    target training data
+    shared: bool, publish/attach the processed arrays in shared memory
+    storage: string, dtype the features are kept in (STORAGE_DTYPES)
+output:
+    X_train_src, y_train_src, X_test_src, y_test_src: processed source data
+    X_train_trg, y_train_trg, X_test_trg, y_test_trg: processed temporal target data
+    (labels are sparse int32)
+    classes: list, class names of the source domain
+'''
+
+
+def get_src_data(filename, train_src_days, train_trg_days, shared=False, storage='float32'):
+    if shared:
+        key = shared_key('get_src_data', filename, os.path.getmtime(filename),
+                         train_src_days, train_trg_days, storage)
+        data = shared_arrays(
+            key, lambda: get_src_data(filename, train_src_days, train_trg_days,
+                                      storage=storage)[:-1])
+        return data + (get_h5classes(filename), )
+
+    X_data, y_data, classes = get_h5dataset(filename)
+    X_data, y_data = balance_dataset(X_data,
+                                     y_data,
+                                     num_days=10,
+                                     num_classes=len(classes),
+                                     max_samples_per_class=95)
+
+    # split days of data to train and test
+    X_src = X_data[y_data[:, 1] < train_src_days]
+    y_src = y_data[y_data[:, 1] < train_src_days, 0]
+    # stratify on the one-hot rows, sklearn orders the strata differently for
+    # sparse labels and the split would change
+    X_train_src, X_test_src, y_train_src, y_test_src = train_test_split(
+        X_src, y_src, stratify=np.eye(len(classes), dtype=np.uint8)[y_src],
+        test_size=0.10, random_state=42)
+
+    X_trg = X_data[y_data[:, 1] >= train_src_days]
+    y_trg = y_data[y_data[:, 1] >= train_src_days]
+    X_train_trg = X_trg[y_trg[:, 1] < train_src_days + train_trg_days]
+    y_train_trg = y_trg[y_trg[:, 1] < train_src_days + train_trg_days, 0]
+
+    X_test_trg = X_data[y_data[:, 1] >= train_src_days + train_trg_days]
+    y_test_trg = y_data[y_data[:, 1] >= train_src_days + train_trg_days, 0]
+
+    del X_src, y_src, X_trg, y_trg, X_data, y_data
+
+    # mean center and normalize dataset
+    X_train_src, src_mean = mean_center(X_train_src)
+    X_train_src, src_min, src_ptp = normalize(X_train_src)
+
+    X_test_src, _ = mean_center(X_test_src, src_mean)
+    X_test_src, _, _ = normalize(X_test_src, src_min, src_ptp)
+
+    if (X_train_trg.shape[0] != 0):
+        X_train_trg, trg_mean = mean_center(X_train_trg)
+        X_train_trg, trg_min, trg_ptp = normalize(X_train_trg)
+
+        X_test_trg, _ = mean_center(X_test_trg, trg_mean)
+        X_test_trg, _, _ = normalize(X_test_trg, trg_min, trg_ptp)
+    else:
+        X_test_trg, _ = mean_center(X_test_trg, src_mean)
+        X_test_trg, _, _ = normalize(X_test_trg, src_min, src_ptp)
+
+    X_train_src = quantize(X_train_src, storage)
+    y_train_src = y_train_src.astype(np.int32)
+    X_test_src = quantize(X_test_src, storage)
+    y_test_src = y_test_src.astype(np.int32)
+    X_train_trg = quantize(X_train_trg, storage)
+    y_train_trg = y_train_trg.astype(np.int32)
+    X_test_trg = quantize(X_test_trg, storage)
+    y_test_trg = y_test_trg.astype(np.int32)
+
+    return X_train_src, y_train_src, X_test_src, y_test_src, \
+        X_train_trg, y_train_trg, X_test_trg, y_test_trg, classes
+
+
+'''
+Shared memory storage for prepared arrays. Concurrent runs on one host
+(day x domain x method grid) all build the same normalized arrays, so the
+first run publishes them as .npy files under SHARED_ROOT (tmpfs) and every
+later run attaches them read-only with np.load(mmap_mode='r'). All runs then
+share the same physical pages instead of holding a private copy each.
+Remove SHARED_ROOT to free the memory once the grid is done.
+'''
+
+SHARED_ROOT = os.getenv('MMWAVE_SHM', '/dev/shm/gaitsada')
+# bump when the layout of the published arrays changes, so arrays left
+# behind by an older run are not attached
+SHARED_FORMAT = 2
+
+
+def shared_key(*parts):
+    return hashlib.sha1(repr((SHARED_FORMAT, ) + parts).encode()).hexdigest()[:16]
+
+
+def publish_arrays(path, arrays):
+    tmp_path = '{}.tmp{}'.format(path, os.getpid())
+    os.makedirs(tmp_path)
+    try:
+        for idx, array in enumerate(arrays):
+            np.save(os.path.join(tmp_path, '{}.npy'.format(idx)),
+                    np.ascontiguousarray(array))
+            if isinstance(array, QuantizedArray):
+                np.savetxt(os.path.join(tmp_path, '{}.quant'.format(idx)),
+                           quant_params(array))
+        try:
+            # atomic publish, readers never see a half written directory
+            os.rename(tmp_path, path)
+        except OSError:
+            # another run published the same key first
+            pass
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def attach_arrays(path):
+    num_arrays = len([f for f in os.listdir(path) if f.endswith('.npy')])
+    arrays = []
+    for idx in range(num_arrays):
+        array = np.load(os.path.join(path, '{}.npy'.format(idx)), mmap_mode='r')
+        quant = os.path.join(path, '{}.quant'.format(idx))
+        if os.path.exists(quant):
+            array = QuantizedArray(array, *np.loadtxt(quant))
+        arrays.append(array)
+    return tuple(arrays)
+
+
+def is_mapped(x_data):
+    # attached from shared memory, possibly behind a QuantizedArray view
+    while x_data is not None:
+        if isinstance(x_data, np.memmap):
+            return True
+        x_data = getattr(x_data, 'base', None)
+    return False
+
+
+def shared_arrays(key, build_fn, *args, **kwargs):
+    path = os.path.join(SHARED_ROOT, key)
+    if not os.path.isdir(path):
+        os.makedirs(SHARED_ROOT, exist_ok=True)
+        publish_arrays(path, build_fn(*args, **kwargs))
+    return attach_arrays(path)
+
+
+'''
+Returns a batched tf.data pipeline over (x_data, y_data), the one pipeline
+factory of all train and test sets. Arrays attached from shared memory are not
+copied into a tf constant, batches are gathered from the read-only buffers by
+index instead.
+args:
+    x_data: numpy array, feature data [number_samples, ...], quantized
+            storage is dequantized to float32 per batch
+    y_data: numpy array, label data [number_samples, ...]
+    batch_size: int, number of samples per batch
+    shuffle: bool, shuffle samples every epoch
+    drop_remainder: bool, drop the last partial batch
+    map_fn: None or function(x_batch, y_batch, seed), applied to every batch in
+            parallel, seed is a stateless random seed [2] drawn per batch
+    seed: None or int, seed of the shuffle and of the per batch seeds
+          (reproducible map_fn)
+    cache: None, '' or string, cache the samples before shuffling, in memory
+           ('') or in files with this prefix. Shared memory arrays are copied
+           once into the cache instead of being gathered every epoch
+    deterministic: None or bool, keep the batch order of the parallel stages,
+                   None uses the tf.data default (True)
+    shard: None or (num_shards, index), keep every num_shards-th sample
+           starting at index (one worker of a multi-worker run)
+output:
+    data: tf.data.Dataset yielding (x_batch, y_batch)
+'''
+
+
+def array_dataset(x_data, y_data, batch_size, shuffle=False, drop_remainder=False,
+                  map_fn=None, seed=None, cache=None, deterministic=None, shard=None):
+    num_samples = x_data.shape[0]
+    if shard is not None:
+        num_samples = len(range(shard[1], num_samples, shard[0]))
+    mapped = is_mapped(x_data)
+    if mapped:
+        def gather(idx):
+            return x_data[idx], y_data[idx]
+
+        def gather_batch(idx):
+            x, y = tf.numpy_function(gather, [idx],
+                                     [tf.as_dtype(x_data.dtype), tf.as_dtype(y_data.dtype)])
+            x.set_shape((None, ) + x_data.shape[1:])
+            y.set_shape((None, ) + y_data.shape[1:])
+            return x, y
+
+        data_set = tf.data.Dataset.range(x_data.shape[0])
+        if shard is not None:
+            data_set = data_set.shard(*shard)
+    if mapped and cache is None:
+        if shuffle:
+            data_set = data_set.shuffle(num_samples, seed=seed)
+        data_set = data_set.batch(batch_size, drop_remainder=drop_remainder)
+        data_set = data_set.map(gather_batch, num_parallel_calls=tf.data.AUTOTUNE,
+                                deterministic=deterministic)
+    else:
+        if mapped:
+            # gathered once in order, every later epoch reads the cache
+            data_set = data_set.batch(batch_size).map(gather_batch).unbatch()
+        else:
+            data_set = tf.data.Dataset.from_tensor_slices((np.asarray(x_data), y_data))
+            if shard is not None:
+                data_set = data_set.shard(*shard)
+        if cache is not None:
+            data_set = data_set.cache(cache)
+        if shuffle:
+            data_set = data_set.shuffle(num_samples, seed=seed)
+        data_set = data_set.batch(batch_size, drop_remainder=drop_remainder)
+    if x_data.dtype != np.float32:
+        scale, offset = quant_params(x_data)
+        data_set = data_set.map(lambda x, y: (dequantize_batch(x, scale, offset), y),
+                                num_parallel_calls=tf.data.AUTOTUNE,
+                                deterministic=deterministic)
+    return map_batches(data_set, map_fn, seed, deterministic)
+
+
+def map_batches(data_set, map_fn=None, seed=None, deterministic=None):
+    if map_fn is not None:
+        # seeds are drawn in batch order before the parallel map, a fixed seed
+        # reproduces every epoch while each epoch still gets new seeds
+        if seed is None:
+            rng = tf.random.Generator.from_non_deterministic_state()
+        else:
+            rng = tf.random.Generator.from_seed(seed)
+        data_set = data_set.map(lambda x, y: (x, y, rng.make_seeds(1)[:, 0]))
+        data_set = data_set.map(map_fn, num_parallel_calls=tf.data.AUTOTUNE,
+                                deterministic=deterministic)
+        data_set = data_set.prefetch(tf.data.AUTOTUNE)
+        # reachable for resume checkpoints, see seed_generators
+        data_set.seed_generators = [rng]
+        return data_set
+    return data_set.prefetch(tf.data.AUTOTUNE)
+
+
+def seed_generators(*datasets):
+    # the random generators that draw the per batch seeds of datasets (empty
+    # for datasets without random maps and for Python datasets)
+    return [rng for data_set in datasets
+            for rng in getattr(data_set, 'seed_generators', [])]
+
+
+'''
+Sharded TFRecord export of one h5 domain file, so workers on different nodes
+can stream disjoint shards from a shared filesystem instead of loading the
+whole file. Samples are ordered by (day, class) and dealt round-robin, every
+shard holds the same class/day mix; inside a shard the order is shuffled.
+X_data is read chunk_size rows at a time and written in its stored dtype
+(quantized files keep scale/offset).
+<name>.json next to the shards holds the sample shape/dtype, the classes,
+per shard the file name and its [class, day, count] table and per day the
+[day, count, sum, min, max] of the (dequantized) values, see shard_statistics.
+args:
+    filename: string, filename of h5py dataset
+    out_dir: string, output directory
+    num_shards: int, number of shards
+    seed: int, seed of the in-shard order
+    chunk_size: int, samples read from the h5 file at once
+output:
+    meta_file: string, path of the metadata json
+'''
+
+
+def export_shards(filename, out_dir, num_shards, seed=0, chunk_size=1024):
+    name = os.path.splitext(os.path.basename(filename))[0]
+    os.makedirs(out_dir, exist_ok=True)
+    with h5py.File(filename, 'r') as hf:
+        X_data = hf.get('X_data')
+        attrs = {k: float(v) for k, v in X_data.attrs.items()}
+        scale, offset = attrs.get('scale', 1.), attrs.get('offset', 0.)
+        y_data = np.array(hf.get('y_data'))[:, :2].astype(np.int64)
+        rng = np.random.RandomState(seed)
+        order = np.lexsort((y_data[:, 0], y_data[:, 1]))
+
+        # per day statistics, sequential pass
+        stats = {}
+        for begin in range(0, X_data.shape[0], chunk_size):
+            x_chunk = dequantize(X_data[begin:begin + chunk_size], scale, offset)
+            days = y_data[begin:begin + chunk_size, 1]
+            for day in np.unique(days):
+                x_day = x_chunk[days == day].astype(np.float64)
+                count, total, low, high = stats.get(int(day), (0, 0., np.inf, -np.inf))
+                stats[int(day)] = (count + x_day.size, total + x_day.sum(),
+                                   min(low, x_day.min()), max(high, x_day.max()))
+
+        shards = []
+        for shard in range(num_shards):
+            indices = rng.permutation(order[shard::num_shards])
+            shard_file = '{}-{:05d}-of-{:05d}.tfrecord'.format(name, shard, num_shards)
+            with tf.io.TFRecordWriter(os.path.join(out_dir, shard_file)) as writer:
+                for begin in range(0, indices.shape[0], chunk_size):
+                    chunk = indices[begin:begin + chunk_size]
+                    # h5py reads increasing indices, write back in shuffled order
+                    rows = np.sort(chunk)
+                    x_chunk = X_data[rows][np.searchsorted(rows, chunk)]
+                    for x, idx in zip(x_chunk, chunk):
+                        feature = {
+                            'x': tf.train.Feature(bytes_list=tf.train.BytesList(
+                                value=[np.ascontiguousarray(x).tobytes()])),
+                            'class': tf.train.Feature(int64_list=tf.train.Int64List(value=[y_data[idx, 0]])),
+                            'day': tf.train.Feature(int64_list=tf.train.Int64List(value=[y_data[idx, 1]])),
+                        }
+                        writer.write(tf.train.Example(
+                            features=tf.train.Features(feature=feature)).SerializeToString())
+            keys, counts = np.unique(y_data[indices], axis=0, return_counts=True)
+            shards.append({'file': shard_file,
+                           'num_samples': int(indices.shape[0]),
+                           'counts': [[int(c), int(d), int(n)] for (c, d), n in zip(keys, counts)]})
+        shape, dtype = list(X_data.shape[1:]), X_data.dtype.str
+
+    meta = {'shape': shape, 'dtype': dtype,
+            'classes': get_h5classes(filename), 'shards': shards,
+            'day_stats': [[day, int(n), float(t), float(lo), float(hi)]
+                          for day, (n, t, lo, hi) in sorted(stats.items())]}
+    meta.update(attrs)
+    meta_file = os.path.join(out_dir, name + '.json')
+    with open(meta_file, 'w') as f:
+        json.dump(meta, f)
+    return meta_file
+
+
+'''
+Normalization statistics of the selected days from the export_shards metadata,
+the mean_center + normalize of get_src_data/get_trg_data computed over all
+samples of those days (the h5 loaders balance and split first, so their
+statistics differ slightly)
+args:
+    meta_file: string, metadata json written by export_shards
+    days: None or (first, last), days with first <= day < last
+output:
+    normalization: (mean, data_min, data_ptp) for shard_dataset
+'''
+
+
+def shard_statistics(meta_file, days=None):
+    with open(meta_file) as f:
+        meta = json.load(f)
+    first, last = days if days is not None else (0, np.iinfo(np.int64).max)
+    stats = np.array([s[1:] for s in meta['day_stats'] if first <= s[0] < last])
+    if stats.shape[0] == 0:
+        raise ValueError('no samples for days {} in {}'.format(days, meta_file))
+    mean = stats[:, 1].sum() / stats[:, 0].sum()
+    data_min, data_max = stats[:, 2].min(), stats[:, 3].max()
+    # mean_center shifts min and max alike, the range is unchanged
+    return mean, data_min - mean, data_max - data_min
+
+
+'''
+Reads an export_shards export as a batched tf.data pipeline. Shards are read
+with a parallel interleave, with a seed the shard order, interleave and sample
+shuffle are reproducible. The metadata gives the number of samples of the
+selected days without a pass over the data, so len() works (EpochZip).
+args:
+    meta_file: string, metadata json written by export_shards
+    batch_size: int, number of samples per batch
+    days: None or (first, last), keep samples with first <= day < last
+    shuffle: bool, shuffle shards and samples every epoch
+    drop_remainder: bool, drop the last partial batch
+    map_fn: None or function(x_batch, y_batch, seed), as in array_dataset
+    seed: None or int, seed of the shuffles and the per batch seeds
+    shard: None or (num_workers, index), read only every num_workers-th shard
+           starting at index, workers stream disjoint shards
+    label_map: None or numpy array, class index lookup (class_lookup)
+    normalization: None or (mean, data_min, data_ptp), mean_center and
+                   normalize with these statistics (shard_statistics)
+    shuffle_buffer: int, samples in the shuffle buffer
+    cycle_length: None or int, shards read concurrently (AUTOTUNE if None)
+    deterministic: None or bool, as in array_dataset
+output:
+    data: tf.data.Dataset yielding (x_batch, y_batch), y sparse int32
+'''
+
+
+def shard_dataset(meta_file, batch_size, days=None, shuffle=False, drop_remainder=False,
+                  map_fn=None, seed=None, shard=None, label_map=None, normalization=None,
+                  shuffle_buffer=4096, cycle_length=None, deterministic=None):
+    with open(meta_file) as f:
+        meta = json.load(f)
+    shards = meta['shards']
+    if shard is not None:
+        shards = shards[shard[1]::shard[0]]
+    files = [os.path.join(os.path.dirname(meta_file), s['file']) for s in shards]
+    first, last = days if days is not None else (0, np.iinfo(np.int64).max)
+    num_samples = sum(n for s in shards for _, day, n in s['counts'] if first <= day < last)
+
+    shape, dtype = meta['shape'], tf.as_dtype(np.dtype(meta['dtype']))
+    scale, offset = meta.get('scale', 1.), meta.get('offset', 0.)
+    label_map = tf.constant(np.arange(len(meta['classes'])) if label_map is None else label_map,
+                            dtype=tf.int32)
+    features = {'x': tf.io.FixedLenFeature([], tf.string),
+                'class': tf.io.FixedLenFeature([], tf.int64),
+                'day': tf.io.FixedLenFeature([], tf.int64)}
+
+    def parse(record):
+        example = tf.io.parse_single_example(record, features)
+        x = tf.reshape(tf.io.decode_raw(example['x'], dtype), shape)
+        return x, example['class'], example['day']
+
+    def keep(x, label, day):
+        return tf.logical_and(day >= first, day < last)
+
+    if normalization is not None:
+        mean, data_min, data_ptp = [np.asarray(v, dtype=np.float32) for v in normalization]
+
+    def convert(x, label, day):
+        x = dequantize_batch(x, scale, offset)
+        if normalization is not None:
+            x = 2. * (x - mean - data_min) / data_ptp - 1
+        return x, tf.gather(label_map, label)
+
+    data_set = tf.data.Dataset.from_tensor_slices(files)
+    if shuffle:
+        data_set = data_set.shuffle(len(files), seed=seed)
+    data_set = data_set.interleave(
+        tf.data.TFRecordDataset,
+        cycle_length=cycle_length if cycle_length is not None else tf.data.AUTOTUNE,
+        num_parallel_calls=tf.data.AUTOTUNE, deterministic=deterministic)
+    data_set = data_set.map(parse, num_parallel_calls=tf.data.AUTOTUNE, deterministic=deterministic)
+    if days is not None:
+        data_set = data_set.filter(keep)
+    data_set = data_set.map(convert, num_parallel_calls=tf.data.AUTOTUNE, deterministic=deterministic)
+    if shuffle:
+        data_set = data_set.shuffle(shuffle_buffer, seed=seed)
+    data_set = data_set.batch(batch_size, drop_remainder=drop_remainder)
+    num_batches = num_samples // batch_size if drop_remainder else -(-num_samples // batch_size)
+    data_set = data_set.apply(tf.data.experimental.assert_cardinality(num_batches))
+    return map_batches(data_set, map_fn, seed, deterministic)
+
 def drop_with_noise(image, _min, _max):
     p = np.random.uniform(0, 1)
     if p<1/3:
@@ -428,66 +1206,739 @@ def preprocessing_function(image):
     overlay_noise(image, _min, _max)
     return image
 
+'''
+Zoom/shear/rotation of a batch of images in the TF graph, composed the same way
+as ImageDataGenerator.apply_transform (rotation x shear x zoom about the same
+center, bilinear interpolation, nearest fill) but with one projective
+transform op for the whole batch. Matches apply_affine_transform to ~1e-5 for
+square and non-square images (see benchmark_augment.py)
+args:
+    images: 4D tensor, with shape [batch_size, height, width, channels]
+    theta: 1D tensor [batch_size], rotation angle in degrees
+    shear: 1D tensor [batch_size], shear angle in degrees
+    zx, zy: 1D tensors [batch_size], zoom factors
+output:
+    images: 4D float32 tensor, transformed images
+'''
+
+
+def affine_transform(images, theta, shear, zx, zy):
+    images = tf.convert_to_tensor(images, tf.float32)
+    shape = tf.shape(images)
+    # ImageDataGenerator offsets the matrix with (height, width) and then
+    # swaps it to (row, col) indexing, so x (columns) turns about height / 2
+    # and y (rows) about width / 2. Kept for non-square images as well.
+    o_x = tf.cast(shape[1], tf.float32) / 2 - 0.5
+    o_y = tf.cast(shape[2], tf.float32) / 2 - 0.5
+    theta = theta * np.pi / 180
+    shear = shear * np.pi / 180
+
+    # maps output (x, y) to input (x, y) coordinates
+    a0 = zx * tf.cos(theta)
+    a1 = -zy * tf.sin(theta + shear)
+    b0 = zx * tf.sin(theta)
+    b1 = zy * tf.cos(theta + shear)
+    a2 = o_x - a0 * o_x - a1 * o_y
+    b2 = o_y - b0 * o_x - b1 * o_y
+
+    zeros = tf.zeros_like(a0)
+    transforms = tf.stack([a0, a1, a2, b0, b1, b2, zeros, zeros], axis=1)
+    return tf.raw_ops.ImageProjectiveTransformV3(images=images,
+                                                 transforms=transforms,
+                                                 output_shape=shape[1:3],
+                                                 fill_value=0.,
+                                                 interpolation='BILINEAR',
+                                                 fill_mode='NEAREST')
+
+
+'''
+Random zoom/shear/rotation of a batch, parameters are drawn per image like
+ImageDataGenerator(zoom_range, shear_range, rotation_range)
+args:
+    images: 4D tensor, with shape [batch_size, height, width, channels]
+    seed: int tensor [2], stateless random seed
+    rotation_range: float, degree range for random rotations
+    shear_range: float, degree range for random shear
+    zoom_range: [lower, upper], range for random zoom (per axis)
+output:
+    images: 4D float32 tensor, augmented images
+'''
+
+
+def random_affine(images, seed, rotation_range=5, shear_range=5, zoom_range=(.8, 1.2)):
+    batch_size = tf.shape(images)[0]
+    u_theta, u_shear, u_zx, u_zy = tf.unstack(
+        tf.random.stateless_uniform([4, batch_size], seed))
+    theta = rotation_range * (2 * u_theta - 1)
+    shear = shear_range * (2 * u_shear - 1)
+    zx = zoom_range[0] + (zoom_range[1] - zoom_range[0]) * u_zx
+    zy = zoom_range[0] + (zoom_range[1] - zoom_range[0]) * u_zy
+    return affine_transform(images, theta, shear, zx, zy)
+
+
+'''
+Batched drop_with_noise, band sizes, positions and noise of the whole batch are
+drawn at once and applied with a broadcasted mask. As in drop_with_noise a
+third of the images get a wide band, a third a tall band and the rest none.
+args:
+    images: 4D float32 tensor, with shape [batch_size, height, width, channels]
+    seed: int tensor [2], stateless random seed
+    _min, _max: float, range of the uniform noise
+output:
+    images: 4D float32 tensor
+'''
+
+
+def drop_with_noise_batch(images, seed, _min, _max):
+    shape = tf.shape(images)
+    batch_size, height, width = shape[0], shape[1], shape[2]
+    seeds = tf.random.experimental.stateless_split(seed, 2)
+    p, u_h, u_w, u_top, u_left = tf.unstack(
+        tf.random.stateless_uniform([5, batch_size], seeds[0]))
+    height_f = tf.cast(height, tf.float32)
+    width_f = tf.cast(width, tf.float32)
+
+    # randint(low, high) == low + floor(u * (high - low))
+    wide = p < 1 / 3
+    band_h = tf.where(wide, 2 + tf.floor(u_h * 6), 1 + tf.floor(u_h * (height_f - 1)))
+    band_w = tf.where(wide, 1 + tf.floor(u_w * (width_f - 1)), 2 + tf.floor(u_w * 6))
+    top = tf.floor(u_top * (height_f - band_h))
+    left = tf.floor(u_left * (width_f - band_w))
+
+    rows = tf.range(height_f)[None, :]
+    cols = tf.range(width_f)[None, :]
+    in_rows = (rows >= top[:, None]) & (rows < (top + band_h)[:, None])
+    in_cols = (cols >= left[:, None]) & (cols < (left + band_w)[:, None])
+    mask = in_rows[:, :, None] & in_cols[:, None, :] & (p < 2 / 3)[:, None, None]
+
+    noise = tf.random.stateless_uniform([batch_size, height, width, 1], seeds[1],
+                                        _min, _max)
+    return tf.where(mask[..., None], noise, images)
+
+
+'''
+Batched overlay_noise, two thirds of the images get uniform noise of a tenth of
+the [_min, _max] range added
+args:
+    images: 4D float32 tensor, with shape [batch_size, height, width, channels]
+    seed: int tensor [2], stateless random seed
+    _min, _max: float, range used to scale the noise
+output:
+    images: 4D float32 tensor
+'''
+
+
+def overlay_noise_batch(images, seed, _min, _max):
+    shape = tf.shape(images)
+    seeds = tf.random.experimental.stateless_split(seed, 2)
+    _length = (_max - _min) / 10
+    apply = tf.random.stateless_uniform([shape[0], 1, 1, 1], seeds[0]) < 2 / 3
+    noise = tf.random.stateless_uniform([shape[0], shape[1], shape[2], 1], seeds[1],
+                                        -_length, _length)
+    return images + tf.where(apply, noise, 0.)
+
+
+'''
+Batched preprocessing_function, usable in tf.data and inside tf.function steps.
+The same seed gives the same augmentation.
+'''
+
+
+def preprocessing_batch(images, seed):
+    _max = 0.9
+    _min = -0.7
+    seeds = tf.random.experimental.stateless_split(seed, 3)
+    images = drop_with_noise_batch(images, seeds[0], _min, _max)
+    images = drop_with_noise_batch(images, seeds[1], _min, _max)
+    return overlay_noise_batch(images, seeds[2], _min, _max)
+
+
+'''
+tf.data map function replacing ImageDataGenerator(zoom_range=[.8, 1.2],
+shear_range=5, rotation_range=5, preprocessing_function=preprocessing_function)
+on batched (images, labels)
+'''
+
+
+def augment_batch(images, labels, seed):
+    seeds = tf.random.experimental.stateless_split(seed, 2)
+    images = random_affine(images, seeds[0])
+    return preprocessing_batch(images, seeds[1]), labels
+
+
+'''
+Paired weak/strong views for FixMatch style training. Every batch is fetched
+once, the weak view is the batch itself and each strong view is augment_batch
+of that same tensor with its own seed, so all views stay aligned sample by
+sample. Replaces ImgGenAnchorDataset (num_strong=1) and
+ImgGenAnchorMultiHardDataset (num_strong>1).
+args:
+    x_data: numpy array, feature data [number_samples, ...]
+    y_data: numpy array, label data [number_samples, ...]
+    batch_size: int, number of samples per batch
+    num_strong: int, number of strong views
+    seed: None or int, seed of the augmentation
+output:
+    data: tf.data.Dataset yielding ((x_weak, x_strong), y), x_strong is a
+          tuple of num_strong batches if num_strong > 1
+'''
+
+
+def weak_strong_dataset(x_data, y_data, batch_size, num_strong=1, seed=None):
+    def weak_strong(images, labels, seed):
+        seeds = tf.random.experimental.stateless_split(seed, num_strong)
+        strongs = tuple(augment_batch(images, labels, seeds[i])[0]
+                        for i in range(num_strong))
+        if num_strong == 1:
+            return (images, strongs[0]), labels
+        return (images, strongs), labels
+
+    return array_dataset(x_data, y_data, batch_size,
+                         shuffle=True, drop_remainder=True,
+                         map_fn=weak_strong, seed=seed)
+
+
+'''
+Augmentation bank, num_variants augmented copies (augment_batch, i.e. the
+imgen + preprocessing_function transforms) of every sample precomputed once
+into an on-disk .npy memmap [num_variants, number_samples, ...]. The file name
+is keyed on a fingerprint of x_data, so restarts and the different views of
+the same data reuse one bank.
+args:
+    bank_dir: string, directory of the bank files
+    x_data: numpy array, feature data [number_samples, ...]
+    num_variants: int, augmented variants per sample
+    dtype: string or numpy dtype, storage type of the bank (float16 halves disk)
+    batch_size: int, number of samples augmented at once
+    seed: int, seed of the augmentation
+output:
+    bank: read-only numpy memmap [num_variants, number_samples, ...]
+'''
+
+
+def augmentation_bank(bank_dir, x_data, num_variants, dtype=np.float16,
+                      batch_size=256, seed=0):
+    dtype = np.dtype(dtype)
+    num_samples = x_data.shape[0]
+    probe = np.ascontiguousarray(x_data[::max(1, num_samples // 64)])
+    key = shared_key('augmentation_bank', x_data.shape,
+                     hashlib.sha1(probe.tobytes()).hexdigest(), num_variants,
+                     dtype.str, seed)
+    filename = os.path.join(bank_dir, key + '.npy')
+    if not os.path.exists(filename):
+        os.makedirs(bank_dir, exist_ok=True)
+        tmp_filename = '{}.tmp{}.npy'.format(filename[:-4], os.getpid())
+        bank = np.lib.format.open_memmap(tmp_filename, mode='w+', dtype=dtype,
+                                         shape=(num_variants, ) + x_data.shape)
+        for variant in range(num_variants):
+            for start in range(0, num_samples, batch_size):
+                batch_seed = tf.constant([seed, variant * num_samples + start], tf.int64)
+                images, _ = augment_batch(dequantize(x_data[start:start + batch_size]),
+                                          None, batch_seed)
+                bank[variant, start:start + batch_size] = images.numpy()
+        bank.flush()
+        del bank
+        os.replace(tmp_filename, filename)
+    return np.load(filename, mmap_mode='r')
+
+
+'''
+Training batches drawn from an augmentation bank. Every epoch reshuffles the
+samples and picks a random variant for every sample.
+args:
+    x_data: numpy array, feature data [number_samples, ...]
+    y_data: numpy array, label data [number_samples, ...]
+    bank: numpy array, augmentation_bank of x_data
+    batch_size: int, number of samples per batch
+    weak_strong: bool, yield ((x_weak, x_strong), y) like weak_strong_dataset
+                 instead of (x_strong, y)
+    seed: None or int, seed of the variant choice
+output:
+    data: tf.data.Dataset
+'''
+
+
+def bank_dataset(x_data, y_data, bank, batch_size, weak_strong=False, seed=None):
+    num_variants, num_samples = bank.shape[:2]
+
+    def gather(idx, variant):
+        strong = bank[variant, idx].astype(np.float32)
+        return strong, dequantize(x_data[idx]) if weak_strong else strong, y_data[idx]
+
+    def gather_batch(idx, variant):
+        strong, weak, y = tf.numpy_function(
+            gather, [idx, variant],
+            [tf.float32, tf.float32, tf.as_dtype(y_data.dtype)])
+        strong.set_shape((None, ) + x_data.shape[1:])
+        weak.set_shape((None, ) + x_data.shape[1:])
+        y.set_shape((None, ) + y_data.shape[1:])
+        if weak_strong:
+            return (weak, strong), y
+        return strong, y
+
+    if seed is None:
+        rng = tf.random.Generator.from_non_deterministic_state()
+    else:
+        rng = tf.random.Generator.from_seed(seed)
+    data_set = tf.data.Dataset.range(num_samples).shuffle(num_samples)
+    data_set = data_set.batch(batch_size, drop_remainder=True)
+    data_set = data_set.map(lambda idx: (idx, rng.uniform(tf.shape(idx), 0, num_variants,
+                                                          dtype=tf.int64)))
+    data_set = data_set.map(gather_batch, num_parallel_calls=tf.data.AUTOTUNE)
+    data_set = data_set.prefetch(tf.data.AUTOTUNE)
+    data_set.seed_generators = [rng]
+    return data_set
+
+
+'''
+Weak/strong batches produced by worker processes. The workers gather a batch,
+run augment_batch on it for every strong view and write the views and labels
+into a preallocated shared-memory ring of `depth` slots. Iterating returns
+numpy views into the ring (no copy), a slot is handed back to the workers on
+the next call to __next__, so a batch is only valid until then. Workers run TF
+on one CPU thread each and never touch the GPU.
+The pool is an endless stream like ImgGenAnchorDataset, __len__ is the number
+of full batches per epoch. wait_time counts the seconds the trainer blocked on
+data since the last reset_states(). close() (also run at exit) stops the
+workers and frees the shared memory.
+args:
+    x_data: numpy array, feature data [number_samples, ...]
+    y_data: numpy array, label data [number_samples, ...]
+    batch_size: int, number of samples per batch
+    num_workers: int, number of worker processes
+    depth: int, number of batches in the ring
+    num_strong: int, number of strong views
+    seed: None or int, seed of the shuffling and augmentation
+output:
+    data: iterator yielding ((x_weak, x_strong), y), x_strong is a tuple of
+          num_strong batches if num_strong > 1
+'''
+
+
+class AugmentationPool:
+    def __init__(self, x_data, y_data, batch_size, num_workers=2, depth=4,
+                 num_strong=1, seed=None):
+        self.batch_size, self.depth, self.num_strong = batch_size, depth, num_strong
+        self.num_samples = x_data.shape[0]
+        self.seed = random.randrange(2**31) if seed is None else seed
+        self.rng = np.random.RandomState(self.seed)
+        self.wait_time, self.batches = 0., 0
+        self.closed = False
+
+        # source arrays once in shared memory, workers attach by name
+        self.shms = []
+        data = [self.share(np.ascontiguousarray(x_data)),
+                self.share(np.ascontiguousarray(y_data))]
+        ring_x = ((depth, 1 + num_strong, batch_size) + x_data.shape[1:], np.float32)
+        ring_y = ((depth, batch_size) + y_data.shape[1:], y_data.dtype)
+        self.ring_x = self.allocate(*ring_x)
+        self.ring_y = self.allocate(*ring_y)
+        ring = [(self.shms[-2].name, ) + ring_x, (self.shms[-1].name, ) + ring_y]
+
+        # every worker reports finished slots on its own pipe, a dead worker
+        # shows up as EOF instead of a silent hang
+        ctx = multiprocessing.get_context('spawn')
+        self.tasks = ctx.Queue()
+        self.workers, self.readers = [], []
+        for _ in range(num_workers):
+            reader, writer = ctx.Pipe(duplex=False)
+            worker = ctx.Process(target=augmentation_worker,
+                                 args=(data, ring, self.tasks, writer, num_strong,
+                                       quant_params(x_data)),
+                                 daemon=True)
+            worker.start()
+            writer.close()
+            self.workers.append(worker)
+            self.readers.append(reader)
+
+        self.order = np.zeros(0, dtype=np.int64)
+        self.pending, self.done = [], set()
+        self.step, self.current = 0, None
+        for slot in range(depth):
+            self.submit(slot)
+        atexit.register(self.close)
+
+    def share(self, array):
+        shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        self.shms.append(shm)
+        np.ndarray(array.shape, array.dtype, buffer=shm.buf)[...] = array
+        return shm.name, array.shape, array.dtype
+
+    def allocate(self, shape, dtype):
+        shm = shared_memory.SharedMemory(create=True,
+                                         size=int(np.prod(shape)) * np.dtype(dtype).itemsize)
+        self.shms.append(shm)
+        return np.ndarray(shape, dtype, buffer=shm.buf)
+
+    def submit(self, slot):
+        # reshuffle once the remainder can not fill a batch (drop_remainder)
+        if self.order.shape[0] < self.batch_size:
+            self.order = self.rng.permutation(self.num_samples)
+        indices, self.order = self.order[:self.batch_size], self.order[self.batch_size:]
+        self.tasks.put((slot, indices, (self.seed, self.step)))
+        self.pending.append(slot)
+        self.step += 1
+
+    def __len__(self):
+        return self.num_samples // self.batch_size
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.current is not None:
+            self.submit(self.current)
+        slot = self.pending.pop(0)
+        start = time.perf_counter()
+        while slot not in self.done:
+            for reader in wait(self.readers):
+                try:
+                    self.done.add(reader.recv())
+                except EOFError:
+                    self.close()
+                    raise RuntimeError('augmentation worker exited')
+        self.wait_time += time.perf_counter() - start
+        self.batches += 1
+        self.done.remove(slot)
+        self.current = slot
+
+        strongs = tuple(self.ring_x[slot, 1:])
+        if self.num_strong == 1:
+            return (self.ring_x[slot, 0], strongs[0]), self.ring_y[slot]
+        return (self.ring_x[slot, 0], strongs), self.ring_y[slot]
+
+    def reset_states(self):
+        self.wait_time, self.batches = 0., 0
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for _ in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+        for reader in self.readers:
+            reader.close()
+        del self.ring_x, self.ring_y
+        for shm in self.shms:
+            try:
+                shm.close()
+            except BufferError:
+                # batches handed out are still referenced, the mapping goes
+                # away with them
+                pass
+            shm.unlink()
+        atexit.unregister(self.close)
+
+
+def augmentation_worker(data, ring, tasks, ready, num_strong, quant):
+    tf.config.set_visible_devices([], 'GPU')
+    tf.config.threading.set_intra_op_parallelism_threads(1)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+    shms = [shared_memory.SharedMemory(name=name) for name, _, _ in data + ring]
+    (x_data, y_data, ring_x, ring_y) = [
+        np.ndarray(shape, dtype, buffer=shm.buf)
+        for shm, (_, shape, dtype) in zip(shms, data + ring)
+    ]
+    augment = tf.function(augment_batch)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        slot, indices, seed = task
+        x, y = dequantize(x_data[indices], *quant), y_data[indices]
+        ring_x[slot, 0] = x
+        seeds = tf.random.experimental.stateless_split(tf.constant(seed, tf.int64), num_strong)
+        for i in range(num_strong):
+            ring_x[slot, 1 + i] = augment(x, y, seeds[i])[0].numpy()
+        ring_y[slot] = y
+        ready.send(slot)
+    del x_data, y_data, ring_x, ring_y
+    for shm in shms:
+        shm.close()
+
+
+'''
+Index batches for one epoch: exactly len() full batches, the remainder is
+dropped and a new permutation is drawn every time the sampler is iterated.
+'''
+class EpochSampler:
+    def __init__(self, num_samples, batch_size, shuffle=True, seed=None):
+        self.num_samples, self.batch_size, self.shuffle = num_samples, batch_size, shuffle
+        self.rng = np.random.default_rng(seed)
+    def __len__(self):
+        return self.num_samples//self.batch_size # math.floor => drop_remainder
+    def __iter__(self):
+        order = self.rng.permutation(self.num_samples) if self.shuffle else np.arange(self.num_samples)
+        for i in range(len(self)):
+            yield order[i*self.batch_size:(i+1)*self.batch_size]
+    def forever(self):
+        return itertools.chain.from_iterable(itertools.repeat(self))
+
+def imgen_batch(imgen, x_batch):
+    # the per-sample work of ImageDataGenerator.flow on an already gathered batch
+    return np.stack([imgen.standardize(imgen.random_transform(x.copy())) for x in x_batch])
+
 class ImgGenDataset:
     def __init__(self, imgen, x_data, y_data, batch_size):
         self.imgen, self.x_data, self.y_data, self.batch_size = imgen, x_data, y_data, batch_size
-        self.imgen_iter = iter(self.imgen.flow(self.x_data, self.y_data, batch_size=self.batch_size))
+        self.sampler = EpochSampler(x_data.shape[0], batch_size)
+        self.batches = self.sampler.forever()
     def __len__(self):
-        return self.x_data.shape[0]//self.batch_size # math.floor => drop_remainder
+        return len(self.sampler)
     def __iter__(self):
         return self
     def __next__(self):
-        data = next(self.imgen_iter)
-        if data[0].shape[0] != self.batch_size:
-            data = next(self.imgen_iter)
-        return data
+        indices = next(self.batches)
+        return imgen_batch(self.imgen, dequantize(self.x_data[indices])), self.y_data[indices]
 
+'''
+Weak and strong views are transforms of the same gathered samples, so they
+stay paired by construction.
+'''
 class ImgGenAnchorDataset:
     def __init__(self, imgen_weak, imgen_strong, x_data, y_data, batch_size, u):
-        self.seed=random.randrange(100)
         self.imgen_weak, self.imgen_strong, self.x_data, self.y_data, self.batch_size = imgen_weak, imgen_strong, x_data, y_data, batch_size
         self.batch_size_u = u * batch_size
-        self.imgen_iter_weak = iter(self.imgen_weak.flow(self.x_data, self.y_data, batch_size=self.batch_size_u, seed=self.seed))
-        self.imgen_iter_strong = iter(self.imgen_strong.flow(self.x_data, batch_size=self.batch_size_u, seed=self.seed))
+        self.sampler = EpochSampler(x_data.shape[0], self.batch_size_u)
+        self.batches = self.sampler.forever()
     def __len__(self):
-        return self.x_data.shape[0]//self.batch_size # math.floor => drop_remainder
+        return len(self.sampler)
     def __iter__(self):
         return self
     def __next__(self):
-        x_weak, y = next(self.imgen_iter_weak)
-        x_strong = next(self.imgen_iter_strong)
-        if x_weak.shape[0] != self.batch_size_u:
-            x_weak, y = next(self.imgen_iter_weak)
-        if x_strong.shape[0] != self.batch_size_u:
-            x_strong = next(self.imgen_iter_strong)
-        return (x_weak, x_strong), y
+        indices = next(self.batches)
+        x = dequantize(self.x_data[indices])
+        return (imgen_batch(self.imgen_weak, x), imgen_batch(self.imgen_strong, x)), self.y_data[indices]
 
 class ImgGenAnchorMultiHardDataset:
     def __init__(self, imgen_weak, imgen_strongs, x_data, y_data, batch_size, u):
-        self.seed=random.randrange(100)
         self.imgen_weak, self.imgen_strongs, self.x_data, self.y_data, self.batch_size = imgen_weak, imgen_strongs, x_data, y_data, batch_size
         self.batch_size_u = u * batch_size
-        self.imgen_iter_weak = iter(self.imgen_weak.flow(self.x_data, self.y_data, batch_size=self.batch_size_u, seed=self.seed))
-        self.imgen_iter_strongs = []
-        for i in range(len(imgen_strongs)):
-            self.imgen_iter_strongs.append(
-                iter(self.imgen_strongs[i].flow(self.x_data, batch_size=self.batch_size_u, seed=self.seed)))
+        self.sampler = EpochSampler(x_data.shape[0], self.batch_size_u)
+        self.batches = self.sampler.forever()
     def __len__(self):
-        return self.x_data.shape[0]//self.batch_size # math.floor => drop_remainder
+        return len(self.sampler)
     def __iter__(self):
         return self
     def __next__(self):
-        x_weak, y = next(self.imgen_iter_weak)
-        if x_weak.shape[0] != self.batch_size_u:
-            x_weak, y = next(self.imgen_iter_weak)
-        
-        x_strongs = []
-        for i in range(len(self.imgen_iter_strongs)):
-            x_strong = next(self.imgen_iter_strongs[i])
-            if x_strong.shape[0] != self.batch_size_u:
-                x_strong = next(self.imgen_iter_strongs[i])
-            x_strongs.append(x_strong)
-        return (x_weak, x_strongs), y
+        indices = next(self.batches)
+        x = dequantize(self.x_data[indices])
+        x_strongs = [imgen_batch(imgen_strong, x) for imgen_strong in self.imgen_strongs]
+        return (imgen_batch(self.imgen_weak, x), x_strongs), self.y_data[indices]
+
+'''
+Zip per-domain datasets for one epoch of max(len) steps. Every stream keeps
+its iterator across epochs and a shorter one is restarted (reshuffled) when
+it runs out, so all batches of the largest domain are used and no batch
+that was already produced is dropped.
+'''
+class EpochZip:
+    def __init__(self, *datasets):
+        self.datasets = datasets
+        self.iterators = [iter(dataset) for dataset in datasets]
+    def __len__(self):
+        return max(map(len, self.datasets))
+    def __iter__(self):
+        for _ in range(len(self)):
+            yield tuple(self.next(i) for i in range(len(self.datasets)))
+    def next(self, i):
+        try:
+            return next(self.iterators[i])
+        except StopIteration:
+            self.iterators[i] = iter(self.datasets[i])
+            return next(self.iterators[i])
+
+'''
+Runs one epoch of step_fn(*batches, *args) over zipped per-domain datasets
+with the EpochZip semantics. With steps_per_execution > 1 and only tf.data
+datasets, steps_per_execution steps are looped inside one tf.function over
+repeated dataset iterators, so the per step Python dispatch is paid once per
+chunk. Metrics updated by step_fn stay on device until they are read. The
+first step runs on its own so the model and optimizer variables are created
+outside the loop. Python datasets (ImgGen*, AugmentationPool) run step by step.
+'''
+class MultiStepRunner:
+    def __init__(self, step_fn, *datasets, steps_per_execution=1):
+        self.step_fn = step_fn
+        self.datasets = datasets
+        self.steps_per_execution = steps_per_execution
+        self.in_graph = steps_per_execution > 1 and \
+            all(isinstance(dataset, tf.data.Dataset) for dataset in datasets)
+        if self.in_graph:
+            self.iterators = [iter(dataset.repeat()) for dataset in datasets]
+            self.multi_step = tf.function(self.steps)
+            self.built = False
+        else:
+            self.zip = EpochZip(*datasets)
+    def __len__(self):
+        return max(map(len, self.datasets))
+    def steps(self, num_steps, *args):
+        for _ in tf.range(num_steps):
+            self.step_fn(*[next(iterator) for iterator in self.iterators], *args)
+    def run(self, *args):
+        if not self.in_graph:
+            for batches in self.zip:
+                self.step_fn(*batches, *args)
+            return
+        start = 0
+        if not self.built:
+            self.step_fn(*[next(iterator) for iterator in self.iterators], *args)
+            self.built = True
+            start = 1
+        for start in range(start, len(self), self.steps_per_execution):
+            num_steps = min(self.steps_per_execution, len(self) - start)
+            self.multi_step(tf.constant(num_steps), *args)
+
+'''
+Scores weight snapshots on a background thread while training continues.
+submit(step) copies the model variables, a worker thread loads them into its
+own replica (model_fn()) and writes the accuracy of every test set to
+summary_writer at that step. At most queue_size snapshots wait, a new one
+replaces the oldest (counted as eval_dropped). close() waits for the queued
+snapshots to be scored.
+args:
+    model: keras model being trained
+    model_fn: function() -> new model of the same architecture
+    predict_fn: function(model, images) -> softmax
+    test_sets: dict, summary name -> (tf.data.Dataset, labels)
+    summary_writer: tf summary writer of the run
+    queue_size: int, number of pending snapshots
+'''
+class AsyncEvaluator:
+    def __init__(self, model, model_fn, predict_fn, test_sets, summary_writer,
+                 queue_size=1):
+        self.model = model
+        self.replica = model_fn()
+        # build both eagerly, the replica variables line up with the model's
+        images = next(iter(next(iter(test_sets.values()))[0]))[0]
+        predict_fn(model, images)
+        predict_fn(self.replica, images)
+        if [v.shape for v in self.replica.variables] != [v.shape for v in model.variables]:
+            raise ValueError('the replica variables do not match the model')
+        self.predict = tf.function(lambda images: predict_fn(self.replica, images))
+        self.test_sets = test_sets
+        self.summary_writer = summary_writer
+        self.pending = collections.deque(maxlen=queue_size)
+        self.cond = threading.Condition()
+        self.closed = False
+        self.dropped = 0
+        self.error = None
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def submit(self, step):
+        if self.error is not None:
+            raise self.error
+        snapshot = [v.numpy() for v in self.model.variables]
+        with self.cond:
+            if len(self.pending) == self.pending.maxlen:
+                self.dropped += 1
+            self.pending.append((step, snapshot))
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.closed:
+                    self.cond.wait()
+                if not self.pending:
+                    return
+                step, snapshot = self.pending.popleft()
+            try:
+                self.evaluate(step, snapshot)
+            except Exception as error:
+                self.error = error
+                return
+
+    def evaluate(self, step, snapshot):
+        for variable, value in zip(self.replica.variables, snapshot):
+            variable.assign(value)
+        with self.summary_writer.as_default():
+            for name, (data_set, y) in self.test_sets.items():
+                probs = np.concatenate([self.predict(x) for x, _ in data_set])
+                tf.summary.scalar(name, np.mean(np.argmax(probs, axis=-1) == y),
+                                  step=step)
+            tf.summary.scalar('eval_dropped', self.dropped, step=step)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.worker.join()
+        if self.error is not None:
+            raise self.error
+
+'''
+Plateau detection to end a training stage early. update() gets the signals of
+one check as name=(value, 'min' or 'max'), e.g. source loss, pseudo-label
+confidence, probe agreement or validation accuracy. A signal improves when it
+beats its best value by more than min_delta, the stage has converged when no
+signal improved for patience consecutive checks. The signals and the stop
+reason are written to the default summary writer.
+'''
+class ConvergenceMonitor:
+    def __init__(self, patience, min_delta=1e-3):
+        self.patience = patience
+        self.min_delta = min_delta
+        self.best = {}
+        self.wait = 0
+        self.stop_reason = None
+
+    def update(self, epoch, **signals):
+        improved = False
+        for name, (value, mode) in signals.items():
+            value = float(value)
+            tf.summary.scalar('convergence/' + name, value, step=epoch)
+            sign = 1 if mode == 'max' else -1
+            if name not in self.best or sign * (value - self.best[name]) > self.min_delta:
+                self.best[name] = value
+                improved = True
+        self.wait = 0 if improved else self.wait + 1
+        if self.patience > 0 and self.wait >= self.patience:
+            self.stop_reason = 'converged at epoch {}: no signal improved by more than {} ' \
+                'in {} checks, best {}'.format(
+                    epoch, self.min_delta, self.wait,
+                    ', '.join('{}={:.4f}'.format(k, v) for k, v in sorted(self.best.items())))
+            tf.summary.text('stop_reason', self.stop_reason, step=epoch)
+            print(self.stop_reason)
+        return self.stop_reason is not None
+
+'''
+Label-free signals on a fixed random subset of (unlabeled) training data:
+mean confidence of the predictions and the fraction of predicted classes that
+agree with the previous call (reset() forgets it, e.g. for a new stage).
+args:
+    predict_fn: function(x_batch) -> softmax, e.g. test_step
+    x_data: numpy array, feature data [number_samples, ...]
+    size: int, number of probe samples
+    batch_size: int, batch size of the predictions
+output:
+    signals: dict of ConvergenceMonitor signals (agreement from the second call)
+'''
+class PredictionProbe:
+    def __init__(self, predict_fn, x_data, size, batch_size, seed=0):
+        size = min(size, x_data.shape[0])
+        idx = np.sort(np.random.RandomState(seed).choice(x_data.shape[0], size,
+                                                          replace=False))
+        self.predict_fn = predict_fn
+        self.data_set = array_dataset(x_data[idx], np.zeros(size, np.int32), batch_size)
+        self.previous = None
+
+    def __call__(self):
+        probs = np.concatenate([self.predict_fn(x) for x, _ in self.data_set])
+        pred = np.argmax(probs, axis=-1)
+        signals = {'probe_confidence': (np.mean(np.max(probs, axis=-1)), 'max')}
+        if self.previous is not None:
+            signals['probe_agreement'] = (np.mean(pred == self.previous), 'max')
+        self.previous = pred
+        return signals
+
+    def reset(self):
+        self.previous = None
 
 def str2bool(v):
     if isinstance(v, bool):
@@ -503,20 +1954,45 @@ def to_one_hot(logits, num_classes=10):
     _argmax = tf.math.argmax(logits, axis=1)
     return tf.one_hot(_argmax, num_classes, dtype=tf.uint8)
 
-class ExponentialMovingAverage:
-    def __init__(self, decay):
-        self.decay=decay
-        self.current_value = None
-        
-    def apply(self,value, mask=None):
-        if self.current_value is None:
-            self.current_value = tf.Variable(value, dtype="float32")
+'''
+EMA of a fixed-shape tensor, the variables are built up front so apply can run
+inside a tf.function and are tracked (checkpointed) with the owning model.
+mask selects the entries that get an update this step. As before, the first
+update of an entry sets it to the value, later ones decay towards the value.
+With bias_correction the average starts from zero instead and value() divides
+by (1 - decay**count) with the update count kept per entry.
+'''
+class ExponentialMovingAverage(tf.Module):
+    def __init__(self, decay, shape, bias_correction=False, name=None):
+        super().__init__(name=name)
+        self.decay = decay
+        self.bias_correction = bias_correction
+        self.average = tf.Variable(tf.zeros(shape), trainable=False, name="average")
+        if bias_correction:
+            self.updates = tf.Variable(tf.zeros(shape), trainable=False, name="updates")
+        else:
+            self.initialized = tf.Variable(tf.zeros(shape), trainable=False, name="initialized")
+
+    def apply(self, value, mask=None):
+        value = tf.cast(value, self.average.dtype)
+        if mask is None:
+            mask = tf.ones_like(value)
+        mask = tf.cast(mask, self.average.dtype)
+        if self.bias_correction:
+            self.average.assign_add((1 - self.decay) * mask * (value - self.average))
+            self.updates.assign_add(mask)
         else:
-            inverse_mask = mask*-1+1
-            current_value = self.decay*self.current_value + (1-self.decay)* \
-                                (mask*value + inverse_mask*self.current_value) # some may not have update values
-            self.current_value.assign(current_value)
-        return self.current_value
+            # rate 1 on the first update of an entry, 1 - decay afterwards
+            rate = mask * (1 - self.decay * self.initialized)
+            self.average.assign_add(rate * (value - self.average))
+            self.initialized.assign(tf.maximum(self.initialized, mask))
+        return self.value()
+
+    def value(self):
+        if not self.bias_correction:
+            return tf.identity(self.average)
+        correction = 1 - tf.pow(tf.constant(self.decay, self.average.dtype), self.updates)
+        return tf.math.divide_no_nan(self.average, correction)
 
 def cosine_similarity(feature_A, feature_B):
     #######################################################